@@ -1,195 +1,1667 @@
 import streamlit as st
 import sqlite3
-from PIL import Image
+import re
+import contextlib
+import queue
+import threading
 import io
-import base64
-import pandas as pd
-from sqlalchemy import create_engine
-import plotly.express as px
-from streamlit_extras import app_logo
-from streamlit_extras.app_logo import add_logo
+import csv
+import itertools
 import datetime
+import uuid
+import hashlib
+import hmac
+import secrets
+import json
+import sys
+import argparse
+import os
+import time
+import collections
+import functools
+import logging
 
-# Set page config for consistent styling
-st.set_page_config(page_title="My App", layout="wide")
+logger = logging.getLogger(__name__)
 
-# Custom CSS for styling
-st.markdown("""
-    <style>
-    .reportview-container {
-        margin-top: -2em;
-    }
-    #MainMenu {visibility: hidden;}
-    .stDeployButton {display:none;}
-    footer {visibility: hidden;}
-    #stDecoration {display:none;}
+# pandas, plotly, SQLAlchemy and PIL are imported inside the functions that use
+# them: only host pages and image uploads need them, and importing them up front
+# took most of the time before a shopper saw the login page.
+
+def apply_page_style():
+    # Set page config for consistent styling
+    st.set_page_config(page_title="My App", layout="wide")
+
+    # Custom CSS for styling
+    st.markdown("""
+        <style>
+        .reportview-container {
+            margin-top: -2em;
+        }
+        #MainMenu {visibility: hidden;}
+        .stDeployButton {display:none;}
+        footer {visibility: hidden;}
+        #stDecoration {display:none;}
     
-    .stApp {
-        background-image: linear-gradient(135deg, rgba(128, 0, 128, 0.3), transparent);
-        backdrop-filter: blur(10px);
-        color: white;
-    }
-    .stButton>button {
-        background-color: #1E88E5;
-        color: white;
-        transition: transform 0.3s ease;
-    }
-    .stButton>button:hover {
-        transform: scale(1.05);
-    }
-    .stTextInput>div>div>input {
-        background-color: #2C2C2C;
-        color: white;
-    }
-    .full-width-image {
-        width: 100vw;
-        height: 100vh;
-        object-fit: cover;
-        position: absolute;
-        top: 0;
-        left: 0;
-        z-index: -1;
-    }
-    .centered-buttons {
-        position: absolute;
-        top: 50%;
-        left: 50%;
-        transform: translate(-50%, -50%);
-        text-align: center;
-    }
-    .centered-buttons button {
-        margin: 0 10px;
-    }
-    .centered-title {
-        text-align: center;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+        .stApp {
+            background-image: linear-gradient(135deg, rgba(128, 0, 128, 0.3), transparent);
+            backdrop-filter: blur(10px);
+            color: white;
+        }
+        .stButton>button {
+            background-color: #1E88E5;
+            color: white;
+            transition: transform 0.3s ease;
+        }
+        .stButton>button:hover {
+            transform: scale(1.05);
+        }
+        .stTextInput>div>div>input {
+            background-color: #2C2C2C;
+            color: white;
+        }
+        .full-width-image {
+            width: 100vw;
+            height: 100vh;
+            object-fit: cover;
+            position: absolute;
+            top: 0;
+            left: 0;
+            z-index: -1;
+        }
+        .centered-buttons {
+            position: absolute;
+            top: 50%;
+            left: 50%;
+            transform: translate(-50%, -50%);
+            text-align: center;
+        }
+        .centered-buttons button {
+            margin: 0 10px;
+        }
+        .centered-title {
+            text-align: center;
+        }
+        </style>
+        """, unsafe_allow_html=True)
+
+# Query profiler. Off unless STORE_PROFILE_QUERIES=1 or a host turns it on from the
+# Profiler tab; when off, the only cost is one attribute check per cursor and page.
+SLOW_QUERY_MS = 100
+PROFILE_HISTORY = 200
+
+class QueryProfiler:
+    """Per-page query counts and timings, shared by every session in this process.
+
+    A page run is opened with page(); statements executed on the same thread
+    while it is open are attributed to that page.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.slow_queries = collections.deque(maxlen=PROFILE_HISTORY)
+
+    def reset(self):
+        with self.lock:
+            self.pages.clear()
+            self.slow_queries.clear()
+
+    def record(self, sql, params, seconds):
+        # Returns the statement's record so fetches can add their time and rows to it
+        run = getattr(self.local, "run", None)
+        if run is None:
+            return None
+        statement = {"sql": sql, "params": params, "ms": seconds * 1000, "rows": 0}
+        run["statements"].append(statement)
+        return statement
+
+    @contextlib.contextmanager
+    def page(self, name):
+        # Fragments are profiled on their own and may open inside a page run
+        outer = getattr(self.local, "run", None)
+        run = {"statements": [], "pandas_ms": 0.0}
+        self.local.run = run
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.local.run = outer
+            self.finish(name, run, (time.perf_counter() - started) * 1000)
+
+    @contextlib.contextmanager
+    def section(self, kind):
+        # Time spent in pandas, not counting the SQL it ran
+        run = getattr(self.local, "run", None)
+        if run is None:
+            yield
+            return
+        sql_before = sum(statement["ms"] for statement in run["statements"])
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            sql_during = sum(statement["ms"] for statement in run["statements"]) - sql_before
+            run[f"{kind}_ms"] += (time.perf_counter() - started) * 1000 - sql_during
+
+    def finish(self, name, run, total_ms):
+        sql_ms = sum(statement["ms"] for statement in run["statements"])
+        slow = [statement for statement in run["statements"] if statement["ms"] >= SLOW_QUERY_MS]
+        for statement in slow:
+            statement["plan"] = explain(statement["sql"], statement["params"])
+            statement["page"] = name
+            statement["at"] = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+            logger.warning("Slow query on %s (%.1f ms, %d rows): %s\n%s", name, statement["ms"], statement["rows"], statement["sql"].strip(), statement["plan"])
+        with self.lock:
+            stats = self.pages.setdefault(name, {
+                "runs": 0, "queries": 0, "sql_ms": 0.0, "pandas_ms": 0.0, "render_ms": 0.0,
+                "recent_ms": collections.deque(maxlen=PROFILE_HISTORY),
+            })
+            stats["runs"] += 1
+            stats["queries"] += len(run["statements"])
+            stats["sql_ms"] += sql_ms
+            stats["pandas_ms"] += run["pandas_ms"]
+            stats["render_ms"] += total_ms - sql_ms - run["pandas_ms"]
+            stats["recent_ms"].append(total_ms)
+            self.slow_queries.extend(slow)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Times every statement and counts the rows fetched from it
+    def __init__(self, conn, profiler):
+        super().__init__(conn)
+        self.profiler = profiler
+        self.statement = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.statement = self.profiler.record(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.statement = self.profiler.record(sql, None, time.perf_counter() - started)
+
+    def _fetched(self, started, rows):
+        if self.statement is not None:
+            self.statement["ms"] += (time.perf_counter() - started) * 1000
+            self.statement["rows"] += rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Hands out instrumented cursors, also to SQLAlchemy and conn.execute(), while profiling is on
+    profiler = None
+
+    def cursor(self, factory=None):
+        if factory is None and self.profiler is not None and self.profiler.enabled:
+            return super().cursor(lambda conn: InstrumentedCursor(conn, self.profiler))
+        return super().cursor() if factory is None else super().cursor(factory)
 
-# Create a connection to the SQLite database
 @st.cache_resource
-def get_database_connection():
-    conn = sqlite3.connect("mydatabase.db", check_same_thread=False)
+def get_profiler():
+    return QueryProfiler(os.environ.get("STORE_PROFILE_QUERIES") == "1")
+
+def profiled_page(page):
+    """Attribute the queries and time of a page function to it in the profiler."""
+    @functools.wraps(page)
+    def wrapper(*args, **kwargs):
+        profiler = get_profiler()
+        if not profiler.enabled:
+            return page(*args, **kwargs)
+        with profiler.page(page.__name__):
+            return page(*args, **kwargs)
+    return wrapper
+
+def explain(sql, params):
+    if params is None:
+        return "(executemany)"
+    try:
+        with get_connection() as conn:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as error:
+        return f"(no plan: {error})"
+    return "\n".join(row[3] for row in plan)
+
+# Database file and connection pool settings
+DATABASE_PATH = "mydatabase.db"
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+
+def open_database_connection():
+    """Open a connection to the store database in WAL mode.
+
+    WAL lets readers run alongside the single writer, and the busy timeout
+    makes a writer wait for the lock instead of failing with
+    "database is locked".
+    """
+    conn = sqlite3.connect(DATABASE_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False, factory=InstrumentedConnection)
+    conn.profiler = get_profiler()
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
-conn = get_database_connection()
-cursor = conn.cursor()
-
-# Create tables (if they don't exist)
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        password TEXT,
-        email TEXT,
-        restore_phrase TEXT
-    )
-""")
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS products (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        price REAL,
-        is_popular INTEGER,
-        description TEXT
+class ConnectionPool:
+    """A bounded pool of SQLite connections shared by every session thread.
+
+    Each borrowed connection is used by one thread at a time and is committed
+    when the borrower is done, or rolled back if it raised.
+    """
+
+    def __init__(self, size):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = open_database_connection()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._idle.put(conn)
+
+@st.cache_resource
+def get_connection_pool():
+    # Created once per process, which is also when pending schema migrations run
+    pool = ConnectionPool(POOL_SIZE)
+    with pool.connection() as conn:
+        migrate(conn)
+    return pool
+
+@st.cache_resource
+def get_engine():
+    # SQLAlchemy keeps its own pool for pandas, opened with the same settings
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import QueuePool
+    get_connection_pool()
+    return create_engine(
+        f"sqlite:///{DATABASE_PATH}",
+        creator=open_database_connection,
+        poolclass=QueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=0,
+        pool_timeout=BUSY_TIMEOUT_MS / 1000,
     )
-""")
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS cart (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        product_id INTEGER,
-        quantity INTEGER,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (product_id) REFERENCES products (id)
+
+def get_connection():
+    # Borrow a pooled connection for one unit of work: `with get_connection() as conn:`
+    return get_connection_pool().connection()
+
+@contextlib.contextmanager
+def get_cursor():
+    # Short-lived cursor on a pooled connection: `with get_cursor() as cursor:`
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+# Schema migrations. PRAGMA user_version holds how many of MIGRATIONS have been
+# applied; migrate() runs the rest, each in its own transaction.
+
+# The tables as the first migrations create them; repair_tables() rebuilds any that has drifted
+# from its definition here. These are frozen with those migrations: later migrations add their
+# own tables and columns in their own steps, so this dict must not change.
+TABLES = {
+    "users": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT,
+            email TEXT,
+            restore_phrase TEXT
+        )
+    """,
+    "products": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            price REAL,
+            is_popular INTEGER,
+            description TEXT
+        )
+    """,
+    "cart": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    """,
+    "purchases": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER,
+            date DATETIME,
+            price REAL,
+            order_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (product_id) REFERENCES products (id),
+            FOREIGN KEY (order_id) REFERENCES orders (id)
+        )
+    """,
+    # One row per checkout; the token makes a replayed checkout a no-op
+    "orders": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token TEXT UNIQUE,
+            user_id INTEGER,
+            total REAL,
+            created_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """,
+    "hosts": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT
+        )
+    """,
+    # Daily sales per product and customer, folded in incrementally from purchases
+    "sales_daily": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            day TEXT,
+            product_id INTEGER,
+            user_id INTEGER,
+            quantity INTEGER,
+            revenue REAL,
+            orders INTEGER,
+            PRIMARY KEY (day, product_id, user_id)
+        )
+    """,
+    "rollup_state": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            name TEXT PRIMARY KEY,
+            last_purchase_id INTEGER
+        )
+    """,
+    # Uploaded product images, stored once with their thumbnails pre-generated
+    "product_images": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            product_id INTEGER PRIMARY KEY,
+            image BLOB,
+            thumb_100 BLOB,
+            thumb_400 BLOB,
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    """,
+}
+
+def add_column(cursor, table, column, declaration):
+    # ALTER TABLE has no IF NOT EXISTS for columns
+    cursor.execute(f'PRAGMA table_info("{table}")')
+    if column.lower() not in (row[1].lower() for row in cursor.fetchall()):
+        cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {declaration}')
+
+def table_shape(cursor, schema, table):
+    # Column names, declared types and keys, plus UNIQUE constraints: what a rebuild would restore
+    cursor.execute(f'PRAGMA {schema}.table_info("{table}")')
+    columns = tuple((row[1], row[2].upper(), row[5]) for row in cursor.fetchall())
+    cursor.execute(f'PRAGMA {schema}.index_list("{table}")')
+    unique_indexes = [row[1] for row in cursor.fetchall() if row[3] == 'u']
+    unique = []
+    for index in unique_indexes:
+        cursor.execute(f'PRAGMA {schema}.index_info("{index}")')
+        unique.append(tuple(row[2] for row in cursor.fetchall()))
+    return columns, sorted(unique)
+
+def rebuild_table(cursor, table, definition):
+    """Recreate `table` from `definition`, copying its rows across.
+
+    SQLite cannot change a column's type or add a key in place. Rows that
+    would break a restored PRIMARY KEY or UNIQUE constraint are dropped,
+    keeping the first one.
+    """
+    cursor.execute(f'PRAGMA table_info("{table}")')
+    existing = {row[1].lower() for row in cursor.fetchall()}
+    cursor.execute(definition.format(name=f"{table}_repaired"))
+    cursor.execute(f'PRAGMA table_info("{table}_repaired")')
+    columns = ", ".join(f'"{row[1]}"' for row in cursor.fetchall() if row[1].lower() in existing)
+    cursor.execute(f'INSERT OR IGNORE INTO "{table}_repaired" ({columns}) SELECT {columns} FROM "{table}" ORDER BY rowid')
+    cursor.execute(f'DROP TABLE "{table}"')
+    cursor.execute(f'ALTER TABLE "{table}_repaired" RENAME TO "{table}"')
+
+def compact_cart(cursor):
+    # Fold duplicate (user_id, product_id) rows into the oldest one, summing their quantities
+    cursor.execute("""
+        UPDATE cart SET quantity = (
+            SELECT SUM(c.quantity) FROM cart c
+            WHERE c.user_id IS cart.user_id AND c.product_id IS cart.product_id
+        )
+        WHERE rowid IN (SELECT MIN(rowid) FROM cart GROUP BY user_id, product_id HAVING COUNT(*) > 1)
+    """)
+    cursor.execute("DELETE FROM cart WHERE rowid NOT IN (SELECT MIN(rowid) FROM cart GROUP BY user_id, product_id)")
+
+def create_tables(cursor):
+    for table, definition in TABLES.items():
+        cursor.execute(definition.format(name=table))
+    # Purchases recorded before orders existed have no price or order
+    add_column(cursor, "purchases", "price", "REAL")
+    add_column(cursor, "purchases", "order_id", "INTEGER")
+
+    # Add example purchases
+    cursor.execute("SELECT COUNT(*) FROM purchases")
+    if cursor.fetchone()[0] == 0:
+        example_purchases = [
+            (1, 1, 2, '2024-08-01'),
+            (2, 2, 1, '2024-08-02'),
+            (3, 3, 3, '2024-08-03')
+        ]
+        cursor.executemany("INSERT INTO purchases (user_id, product_id, quantity, date) VALUES (?, ?, ?, ?)", example_purchases)
+
+def repair_tables(cursor):
+    # Undo drift left by older versions that rewrote whole tables with pandas to_sql
+    for table, definition in TABLES.items():
+        cursor.execute(definition.format(name=f"temp.expected_{table}"))
+        if table_shape(cursor, "main", table) != table_shape(cursor, "temp", f"expected_{table}"):
+            rebuild_table(cursor, table, definition)
+        cursor.execute(f"DROP TABLE temp.expected_{table}")
+
+def create_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_popular_id ON products (is_popular, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_product_id ON purchases (product_id)")
+
+    # One cart row per user and product; carts filled before this index existed are merged first
+    compact_cart(cursor)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_cart_user_product ON cart (user_id, product_id)")
+
+    # Full-text index over product names and descriptions, kept in sync by triggers
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description, content='products', content_rowid='id', prefix='2 3'
+        )
+    """)
+    cursor.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    """)
+
+def create_accounts(cursor):
+    # Values the app generates once per database, such as the session signing secret
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+    # Users and hosts in one place, so login is a single lookup on the username indexes
+    cursor.execute("""
+        CREATE VIEW IF NOT EXISTS accounts AS
+        SELECT 'user' AS role, id, username, email, password, restore_phrase FROM users
+        UNION ALL
+        SELECT 'host' AS role, id, username, NULL, password, NULL FROM hosts
+    """)
+
+def create_recommendation_tables(cursor):
+    # Time-decayed sales per product, in units of POPULARITY_HALF_LIFE_DAYS from the
+    # popularity epoch, so new sales are simply added and ORDER BY score is the ranking
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS product_popularity (
+            product_id INTEGER PRIMARY KEY,
+            score REAL,
+            FOREIGN KEY (product_id) REFERENCES products (id)
+        )
+    """)
+    # How often other_id was bought in the same basket (same customer, same day) as product_id
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS product_pairs (
+            product_id INTEGER,
+            other_id INTEGER,
+            weight INTEGER,
+            PRIMARY KEY (product_id, other_id)
+        ) WITHOUT ROWID
+    """)
+    # Top-k lookups walk these indexes and stop after k rows
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_popularity_score ON product_popularity (score)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_pairs_weight ON product_pairs (product_id, weight)")
+    # Baskets are a customer's purchases on one day; this index also covers lookups by user_id alone
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases (user_id, date)")
+    cursor.execute("DROP INDEX IF EXISTS idx_purchases_user_id")
+
+def create_job_tables(cursor):
+    # Deferred work run by the background job workers
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            payload TEXT,
+            dedupe_key TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            run_after REAL,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            error TEXT
+        )
+    """)
+    # One record per order, written by the order_confirmation job
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_confirmations (
+            order_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            email TEXT,
+            total REAL,
+            items TEXT,
+            created_at DATETIME,
+            FOREIGN KEY (order_id) REFERENCES orders (id)
+        )
+    """)
+    # At most one queued job per dedupe key; a job that is already running does not block a new one
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key) WHERE status = 'queued'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_order_id ON purchases (order_id)")
+
+def create_stock_tables(cursor):
+    # NULL stock means the product's stock is not tracked and it never runs out
+    add_column(cursor, "products", "stock", "INTEGER")
+    # Stock held for a shopper's cart lines until expires_at
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            user_id INTEGER,
+            product_id INTEGER,
+            quantity INTEGER,
+            expires_at REAL,
+            PRIMARY KEY (user_id, product_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_reservations_product ON stock_reservations (product_id, expires_at)")
+    # Selling stock updates products on every checkout; only name and description changes touch the search index
+    cursor.execute("DROP TRIGGER IF EXISTS products_fts_update")
+    cursor.execute("""
+        CREATE TRIGGER products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+    """)
+
+def create_purchase_date_index(cursor):
+    # Hourly dashboard buckets read raw purchases for a date range
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases (date)")
+
+def create_narrow_sales_rollups(cursor):
+    # Per-product and per-customer daily sales, so unfiltered dashboard views read far fewer rows
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily_product (
+            day TEXT,
+            product_id INTEGER,
+            quantity INTEGER,
+            revenue REAL,
+            orders INTEGER,
+            PRIMARY KEY (day, product_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily_customer (
+            day TEXT,
+            user_id INTEGER,
+            quantity INTEGER,
+            revenue REAL,
+            orders INTEGER,
+            PRIMARY KEY (day, user_id)
+        )
+    """)
+    # The dashboard's product and customer lists
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_daily_product_product ON sales_daily_product (product_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sales_daily_customer_user ON sales_daily_customer (user_id)")
+    # Start from the existing rollup, which is at the same high-water mark
+    cursor.execute("""
+        INSERT INTO sales_daily_product (day, product_id, quantity, revenue, orders)
+        SELECT day, product_id, SUM(quantity), SUM(revenue), SUM(orders) FROM sales_daily GROUP BY day, product_id
+    """)
+    cursor.execute("""
+        INSERT INTO sales_daily_customer (day, user_id, quantity, revenue, orders)
+        SELECT day, user_id, SUM(quantity), SUM(revenue), SUM(orders) FROM sales_daily GROUP BY day, user_id
+    """)
+
+def add_session_versions(cursor):
+    # Bumped to revoke every session token signed for the account
+    add_column(cursor, "users", "session_version", "INTEGER NOT NULL DEFAULT 0")
+    add_column(cursor, "hosts", "session_version", "INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("DROP VIEW IF EXISTS accounts")
+    cursor.execute("""
+        CREATE VIEW accounts AS
+        SELECT 'user' AS role, id, username, email, password, restore_phrase, session_version FROM users
+        UNION ALL
+        SELECT 'host' AS role, id, username, NULL, password, NULL, session_version FROM hosts
+    """)
+
+def create_grid_indexes(cursor):
+    # Columns hosts sort and filter the table grids on; the grid only offers indexed columns
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email ON users (email)")
+
+def create_stock_index(cursor):
+    # Lets hosts sort and filter the products grid on stock, e.g. to find what sold out
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_stock ON products (stock)")
+
+def add_job_heartbeats(cursor):
+    # Leases run from the last heartbeat, not from the start, so long jobs are not run twice
+    add_column(cursor, "jobs", "heartbeat_at", "REAL")
+    cursor.execute("UPDATE jobs SET heartbeat_at = started_at WHERE status = 'running'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_heartbeat ON jobs (status, heartbeat_at)")
+
+def drop_session_versions(cursor):
+    # Sessions live only in server-side session state now, so there are no tokens left to revoke
+    cursor.execute("DROP VIEW IF EXISTS accounts")
+    cursor.execute("""
+        CREATE VIEW accounts AS
+        SELECT 'user' AS role, id, username, email, password, restore_phrase FROM users
+        UNION ALL
+        SELECT 'host' AS role, id, username, NULL, password, NULL FROM hosts
+    """)
+    cursor.execute("ALTER TABLE users DROP COLUMN session_version")
+    cursor.execute("ALTER TABLE hosts DROP COLUMN session_version")
+    cursor.execute("DELETE FROM settings WHERE name = 'session_secret'")
+
+MIGRATIONS = [
+    create_tables,
+    repair_tables,
+    create_indexes,
+    create_accounts,
+    create_recommendation_tables,
+    create_job_tables,
+    create_stock_tables,
+    create_purchase_date_index,
+    create_narrow_sales_rollups,
+    add_session_versions,
+    create_grid_indexes,
+    add_job_heartbeats,
+    create_stock_index,
+    drop_session_versions,
+]
+
+def migrate(conn):
+    """Apply the migrations this database has not seen yet.
+
+    The version is re-read under BEGIN IMMEDIATE, so when several processes
+    start together each migration still runs only once.
+    """
+    cursor = conn.cursor()
+    while True:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("PRAGMA user_version")
+        version = cursor.fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            return
+        MIGRATIONS[version](cursor)
+        cursor.execute(f"PRAGMA user_version = {version + 1}")
+        conn.commit()
+
+# Queries that run on every shopper rerun or click, with sample parameters.
+# check_query_plans() reports any of them whose plan scans a whole table.
+HOT_QUERIES = {
+    "login": ("SELECT role, id, username, email, password, restore_phrase FROM accounts WHERE username = ?", ("",)),
+    "product page": ("SELECT id, name, price, is_popular, description FROM products WHERE is_popular = 0 AND id > ? ORDER BY id LIMIT ?", (0, 21)),
+    "popular products": ("SELECT id, name, price, is_popular, description FROM products WHERE is_popular = 1", ()),
+    "product image": ("SELECT thumb_100 FROM product_images WHERE product_id = ?", (1,)),
+    "cart": ("SELECT p.id, p.name, p.price, c.quantity FROM cart c JOIN products p ON c.product_id = p.id WHERE c.user_id = ?", (1,)),
+    "cart quantity": ("UPDATE cart SET quantity = ? WHERE user_id = ? AND product_id = ?", (1, 1, 1)),
+    "checkout total": ("SELECT COUNT(*), SUM(c.quantity * p.price) FROM cart c JOIN products p ON c.product_id = p.id WHERE c.user_id = ?", (1,)),
+    "checkout replay": ("SELECT total FROM orders WHERE token = ?", ("",)),
+    "empty cart": ("DELETE FROM cart WHERE user_id = ?", (1,)),
+    "sales rollup": ("""
+        SELECT date(pu.date), pu.product_id, pu.user_id, SUM(pu.quantity), SUM(pu.quantity * COALESCE(pu.price, p.price)), COUNT(*)
+        FROM purchases pu JOIN products p ON pu.product_id = p.id JOIN users u ON pu.user_id = u.id
+        WHERE pu.id > ? AND pu.id <= ?
+        GROUP BY date(pu.date), pu.product_id, pu.user_id
+    """, (0, 0)),
+    "user purchases": ("SELECT product_id FROM purchases WHERE user_id = ?", (1,)),
+    "recent purchases": ("SELECT product_id FROM purchases WHERE user_id = ? ORDER BY date DESC LIMIT ?", (1, 20)),
+    "top popularity": ("""
+        SELECT p.id, p.name, p.price, p.is_popular, p.description
+        FROM product_popularity pp JOIN products p ON p.id = pp.product_id
+        ORDER BY pp.score DESC LIMIT ?
+    """, (20,)),
+    "also bought": ("SELECT other_id, weight FROM product_pairs WHERE product_id = ? ORDER BY weight DESC LIMIT ?", (1, 20)),
+    "order lines": ("SELECT product_id, quantity, price FROM purchases WHERE order_id = ?", (1,)),
+    "reserved stock": ("""
+        SELECT COALESCE(SUM(quantity), 0) FROM stock_reservations
+        WHERE product_id = ? AND user_id != ? AND expires_at > ?
+    """, (1, 1, 0)),
+    "take stock": ("""
+        UPDATE products SET stock = products.stock - c.quantity
+        FROM cart c
+        WHERE c.user_id = ? AND c.product_id = products.id AND products.stock IS NOT NULL
+    """, (1,)),
+    "hourly sales": ("""
+        SELECT strftime('%Y-%m-%d %H:00:00', pu.date), SUM(pu.quantity * COALESCE(pu.price, p.price))
+        FROM purchases pu JOIN products p ON pu.product_id = p.id JOIN users u ON pu.user_id = u.id
+        WHERE pu.date >= ? AND pu.date < ?
+        GROUP BY 1
+    """, ("2024-01-01", "2024-01-02")),
+    "product purchases": ("SELECT user_id FROM purchases WHERE product_id = ?", (1,)),
+}
+
+def check_query_plans(cursor):
+    """Return {query name: plan steps} for every hot query that scans a table instead of searching an index."""
+    failures = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        steps = [row[3] for row in cursor.fetchall()]
+        # Scanning a view's co-routine only walks the rows its own (indexed) subqueries produced
+        subqueries = {step.split()[-1] for step in steps if step.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+        # A top-k query that reads an index in order, with no sort step, stops after LIMIT rows
+        top_k = "LIMIT" in sql and not any("TEMP B-TREE" in step for step in steps)
+        scans = [step for step in steps
+                 if step.startswith("SCAN ") and "VIRTUAL TABLE" not in step and step.split()[1] not in subqueries
+                 and not (top_k and " INDEX " in step)]
+        if scans:
+            failures[name] = scans
+    return failures
+
+# Global variables
+def init_session_state():
+    if 'current_user' not in st.session_state:
+        st.session_state.current_user = None
+    if 'current_host' not in st.session_state:
+        st.session_state.current_host = None
+    if 'page' not in st.session_state:
+        st.session_state.page = "Login"
+
+# Number of products shown per page on the Products tab
+PRODUCTS_PAGE_SIZE = 20
+
+# Seconds a cached catalog read is trusted for when no host edit invalidated it,
+# so changes made outside the app still show up eventually
+CATALOG_CACHE_TTL = 600
+
+# Cached product catalog, shared by every session in this process
+@st.cache_resource
+def get_catalog_generation():
+    return {"value": 0}
+
+def invalidate_catalog():
+    # Bumping the generation makes every cached catalog read below miss on its next call
+    get_catalog_generation()["value"] += 1
+
+def catalog_generation():
+    return get_catalog_generation()["value"]
+
+# Product images: thumbnail sizes the pages use, and how many encoded thumbnails stay in memory
+THUMBNAIL_SIZES = (100, 400)
+IMAGE_CACHE_ENTRIES = 512
+
+def make_thumbnail(data, size):
+    # Crop the uploaded image to a square and encode it once as JPEG
+    from PIL import Image, ImageOps
+    img = ImageOps.fit(Image.open(io.BytesIO(data)).convert('RGB'), (size, size))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+# Per-product image versions, so an upload only drops that product's cached thumbnails
+@st.cache_resource
+def get_image_versions():
+    return {}
+
+def save_product_image(product_id, data):
+    """Store an image and its thumbnails; returns False if there is no such product."""
+    # Raises PIL.UnidentifiedImageError before touching the database if the data is not an image
+    thumbnails = [make_thumbnail(data, size) for size in THUMBNAIL_SIZES]
+    with get_cursor() as cursor:
+        cursor.execute("SELECT 1 FROM products WHERE id = ?", (product_id,))
+        if cursor.fetchone() is None:
+            return False
+        cursor.execute("""
+            INSERT INTO product_images (product_id, image, thumb_100, thumb_400) VALUES (?, ?, ?, ?)
+            ON CONFLICT (product_id) DO UPDATE SET
+                image = excluded.image, thumb_100 = excluded.thumb_100, thumb_400 = excluded.thumb_400
+        """, (product_id, data, *thumbnails))
+    versions = get_image_versions()
+    versions[product_id] = versions.get(product_id, 0) + 1
+    return True
+
+@st.cache_resource
+def placeholder_image():
+    # The gray square shown for products without an image, encoded once per process
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (max(THUMBNAIL_SIZES), max(THUMBNAIL_SIZES)), color='gray').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@st.cache_data(max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def load_thumbnail(product_id, size, version):
+    with get_cursor() as cursor:
+        cursor.execute(f"SELECT thumb_{size} FROM product_images WHERE product_id = ?", (product_id,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def product_image(product_id, size):
+    """Return encoded image bytes for a product, ready for st.image without re-encoding."""
+    return load_thumbnail(product_id, size, get_image_versions().get(product_id, 0)) or placeholder_image()
+
+# Sales rollups for the host dashboard: daily sales per product, per customer,
+# and per product and customer for when the dashboard filters on both.
+# Each maps to its key columns besides the day.
+SALES_ROLLUPS = {
+    "sales_daily_product": ("product_id",),
+    "sales_daily_customer": ("user_id",),
+    "sales_daily": ("product_id", "user_id"),
+}
+
+def refresh_sales_rollup(cursor):
+    """Fold purchases newer than the rollups' high-water mark into every sales rollup.
+
+    Must run inside a write transaction so that two refreshes cannot count
+    the same purchases twice.
+    """
+    cursor.execute("SELECT last_purchase_id FROM rollup_state WHERE name = 'sales_daily'")
+    row = cursor.fetchone()
+    last_id = row[0] if row else 0
+    cursor.execute("SELECT MAX(id) FROM purchases")
+    max_id = cursor.fetchone()[0]
+    if max_id is None or max_id <= last_id:
+        return
+    for table, keys in SALES_ROLLUPS.items():
+        key_columns = ", ".join(f"pu.{key}" for key in keys)
+        cursor.execute(f"""
+            INSERT INTO {table} (day, {", ".join(keys)}, quantity, revenue, orders)
+            SELECT date(pu.date), {key_columns}, SUM(pu.quantity), SUM(pu.quantity * COALESCE(pu.price, p.price)), COUNT(*)
+            FROM purchases pu
+            JOIN products p ON pu.product_id = p.id
+            JOIN users u ON pu.user_id = u.id
+            WHERE pu.id > ? AND pu.id <= ?
+            GROUP BY date(pu.date), {key_columns}
+            ON CONFLICT (day, {", ".join(keys)}) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue,
+                orders = orders + excluded.orders
+        """, (last_id, max_id))
+    cursor.execute("""
+        INSERT INTO rollup_state (name, last_purchase_id) VALUES ('sales_daily', ?)
+        ON CONFLICT (name) DO UPDATE SET last_purchase_id = excluded.last_purchase_id
+    """, (max_id,))
+
+def rebuild_sales_rollup():
+    """Recompute the sales rollups from every purchase, after edits that rewrite past sales.
+
+    Runs as a queued sales_rollup job. The purchases are aggregated into temp
+    tables under a read snapshot, so the write lock, which checkouts wait
+    on, is only held while the rollups are swapped for them.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM purchases")
+        max_id = cursor.fetchone()[0]
+        cursor.execute("DROP TABLE IF EXISTS temp.sales_rebuild")
+        cursor.execute("""
+            CREATE TEMP TABLE sales_rebuild AS
+            SELECT date(pu.date) AS day, pu.product_id, pu.user_id, SUM(pu.quantity) AS quantity,
+                   SUM(pu.quantity * COALESCE(pu.price, p.price)) AS revenue, COUNT(*) AS orders
+            FROM purchases pu
+            JOIN products p ON pu.product_id = p.id
+            JOIN users u ON pu.user_id = u.id
+            WHERE pu.id <= ?
+            GROUP BY date(pu.date), pu.product_id, pu.user_id
+        """, (max_id,))
+        conn.commit()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for table, keys in SALES_ROLLUPS.items():
+                cursor.execute(f"DELETE FROM {table}")
+                cursor.execute(f"""
+                    INSERT INTO {table} (day, {", ".join(keys)}, quantity, revenue, orders)
+                    SELECT day, {", ".join(keys)}, SUM(quantity), SUM(revenue), SUM(orders)
+                    FROM temp.sales_rebuild GROUP BY day, {", ".join(keys)}
+                """)
+            cursor.execute("""
+                INSERT INTO rollup_state (name, last_purchase_id) VALUES ('sales_daily', ?)
+                ON CONFLICT (name) DO UPDATE SET last_purchase_id = excluded.last_purchase_id
+            """, (max_id,))
+            # Purchases made while the snapshot was being aggregated
+            refresh_sales_rollup(cursor)
+            conn.commit()
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS temp.sales_rebuild")
+
+def queue_sales_rollup_rebuild(cursor):
+    # In the caller's transaction, with its own dedupe key so a queued catch-up does not absorb it
+    enqueue_job(cursor, "sales_rollup", {"rebuild": True}, dedupe_key="sales_rollup_rebuild")
+
+def catch_up_sales_rollup(rebuild=False):
+    if rebuild:
+        rebuild_sales_rollup()
+        return
+    # Only take the write lock when there are purchases the rollup has not seen
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT (SELECT MAX(id) FROM purchases) >
+                   COALESCE((SELECT last_purchase_id FROM rollup_state WHERE name = 'sales_daily'), 0)
+        """)
+        if cursor.fetchone()[0]:
+            cursor.execute("BEGIN IMMEDIATE")
+            refresh_sales_rollup(cursor)
+
+# Recommendations: time-decayed popularity and "customers also bought" pairs,
+# folded in from new purchases by the recommendations job, so pages only read
+# the top few rows of an index.
+POPULARITY_HALF_LIFE_DAYS = 14
+# Scores grow as 2 ** (days since epoch / half-life); past this many days they are scaled back down
+POPULARITY_REBASE_DAYS = 365
+RECOMMENDATION_REFRESH_SECONDS = 60
+# Products shown on the Popular tab and in the home page's recommendations
+POPULAR_PRODUCTS = 20
+RECOMMENDED_PRODUCTS = 5
+
+def refresh_recommendations(cursor):
+    """Fold purchases newer than the last refresh into product_popularity and product_pairs.
+
+    Like refresh_sales_rollup, this must run inside a write transaction.
+    """
+    cursor.execute("SELECT last_purchase_id FROM rollup_state WHERE name = 'recommendations'")
+    row = cursor.fetchone()
+    last_id = row[0] if row else 0
+    cursor.execute("SELECT MAX(id) FROM purchases")
+    max_id = cursor.fetchone()[0]
+    if max_id is None or max_id <= last_id:
+        return
+
+    cursor.execute("SELECT julianday('now')")
+    today = cursor.fetchone()[0]
+    cursor.execute("SELECT value FROM settings WHERE name = 'popularity_epoch'")
+    row = cursor.fetchone()
+    epoch = float(row[0]) if row else None
+    if epoch is None or today - epoch > POPULARITY_REBASE_DAYS:
+        if epoch is not None:
+            cursor.execute("UPDATE product_popularity SET score = score * ?", (2 ** ((epoch - today) / POPULARITY_HALF_LIFE_DAYS),))
+        epoch = today
+        cursor.execute("""
+            INSERT INTO settings (name, value) VALUES ('popularity_epoch', ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+        """, (str(epoch),))
+
+    cursor.execute("""
+        SELECT product_id, julianday(date(date)), SUM(quantity)
+        FROM purchases
+        WHERE id > ? AND id <= ?
+        GROUP BY product_id, date(date)
+    """, (last_id, max_id))
+    scores = collections.defaultdict(float)
+    for product_id, day, quantity in cursor.fetchall():
+        scores[product_id] += (quantity or 0) * 2 ** (((day or epoch) - epoch) / POPULARITY_HALF_LIFE_DAYS)
+    cursor.executemany("""
+        INSERT INTO product_popularity (product_id, score) VALUES (?, ?)
+        ON CONFLICT (product_id) DO UPDATE SET score = score + excluded.score
+    """, list(scores.items()))
+
+    # Each new purchase pairs with the rest of its basket. Pairs with older
+    # purchases are counted in both directions here; pairs of two new ones
+    # come out once from each side.
+    cursor.execute("""
+        INSERT INTO product_pairs (product_id, other_id, weight)
+        SELECT product_id, other_id, COUNT(*) FROM (
+            SELECT a.product_id, b.product_id AS other_id
+            FROM purchases a
+            JOIN purchases b ON b.user_id = a.user_id AND b.date >= date(a.date) AND b.date < date(a.date, '+1 day')
+            WHERE a.id > ? AND a.id <= ? AND b.product_id != a.product_id
+            UNION ALL
+            SELECT b.product_id, a.product_id
+            FROM purchases a
+            JOIN purchases b ON b.user_id = a.user_id AND b.date >= date(a.date) AND b.date < date(a.date, '+1 day')
+            WHERE a.id > ? AND a.id <= ? AND b.product_id != a.product_id AND b.id <= ?
+        )
+        GROUP BY product_id, other_id
+        ON CONFLICT (product_id, other_id) DO UPDATE SET weight = weight + excluded.weight
+    """, (last_id, max_id, last_id, max_id, last_id))
+
+    cursor.execute("""
+        INSERT INTO rollup_state (name, last_purchase_id) VALUES ('recommendations', ?)
+        ON CONFLICT (name) DO UPDATE SET last_purchase_id = excluded.last_purchase_id
+    """, (max_id,))
+
+def rebuild_recommendations():
+    """Recompute popularity and pairs from every purchase, after edits that rewrite past purchases.
+
+    Runs as a queued recommendations job and swaps the result in the way
+    rebuild_sales_rollup does, so the pair self-join over the whole history
+    never runs under the write lock.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT COALESCE(MAX(id), 0), julianday('now') FROM purchases")
+        max_id, epoch = cursor.fetchone()
+        cursor.execute("""
+            SELECT product_id, julianday(date(date)), SUM(quantity)
+            FROM purchases
+            WHERE id <= ?
+            GROUP BY product_id, date(date)
+        """, (max_id,))
+        scores = collections.defaultdict(float)
+        for product_id, day, quantity in cursor.fetchall():
+            scores[product_id] += (quantity or 0) * 2 ** (((day or epoch) - epoch) / POPULARITY_HALF_LIFE_DAYS)
+        cursor.execute("DROP TABLE IF EXISTS temp.popularity_rebuild")
+        cursor.execute("DROP TABLE IF EXISTS temp.pairs_rebuild")
+        cursor.execute("CREATE TEMP TABLE popularity_rebuild (product_id INTEGER, score REAL)")
+        cursor.executemany("INSERT INTO temp.popularity_rebuild VALUES (?, ?)", list(scores.items()))
+        cursor.execute("""
+            CREATE TEMP TABLE pairs_rebuild AS
+            SELECT a.product_id, b.product_id AS other_id, COUNT(*) AS weight
+            FROM purchases a
+            JOIN purchases b ON b.user_id = a.user_id AND b.date >= date(a.date) AND b.date < date(a.date, '+1 day')
+            WHERE a.id <= ? AND b.id <= ? AND b.product_id != a.product_id
+            GROUP BY a.product_id, b.product_id
+        """, (max_id, max_id))
+        conn.commit()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM product_popularity")
+            cursor.execute("INSERT INTO product_popularity (product_id, score) SELECT product_id, score FROM temp.popularity_rebuild")
+            cursor.execute("DELETE FROM product_pairs")
+            cursor.execute("INSERT INTO product_pairs (product_id, other_id, weight) SELECT product_id, other_id, weight FROM temp.pairs_rebuild")
+            cursor.execute("""
+                INSERT INTO settings (name, value) VALUES ('popularity_epoch', ?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            """, (str(epoch),))
+            cursor.execute("""
+                INSERT INTO rollup_state (name, last_purchase_id) VALUES ('recommendations', ?)
+                ON CONFLICT (name) DO UPDATE SET last_purchase_id = excluded.last_purchase_id
+            """, (max_id,))
+            # Purchases made while the snapshot was being aggregated
+            refresh_recommendations(cursor)
+            conn.commit()
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS temp.popularity_rebuild")
+            cursor.execute("DROP TABLE IF EXISTS temp.pairs_rebuild")
+
+def queue_recommendations_rebuild(cursor):
+    # In the caller's transaction; until the rebuild runs, pages keep the current recommendations
+    enqueue_job(cursor, "recommendations", {"rebuild": True}, dedupe_key="recommendations_rebuild")
+
+def catch_up_recommendations(rebuild=False):
+    if rebuild:
+        rebuild_recommendations()
+        return
+    # Only take the write lock when there are purchases the recommendations have not seen
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT (SELECT MAX(id) FROM purchases) >
+                   COALESCE((SELECT last_purchase_id FROM rollup_state WHERE name = 'recommendations'), 0)
+        """)
+        if cursor.fetchone()[0]:
+            cursor.execute("BEGIN IMMEDIATE")
+            refresh_recommendations(cursor)
+
+# Background jobs. Work that does not have to finish before a page renders is
+# queued in the jobs table, in the same transaction as the change that needs
+# it, and run by a few worker threads per process. Failed jobs are retried
+# with exponential backoff; a job whose dedupe key is already queued is not
+# queued again, so bursts of checkouts share one rollup refresh.
+JOB_WORKERS = 2
+JOB_MAX_ATTEMPTS = 5
+# First retry delay; doubled on every further attempt
+JOB_RETRY_SECONDS = 2
+# A running job whose heartbeat is older than this is assumed lost with its process and run again
+JOB_LEASE_SECONDS = 600
+# How often a running job's heartbeat is renewed, well within the lease
+JOB_HEARTBEAT_SECONDS = 60
+# Finished jobs are kept this long for the Jobs tab
+JOB_HISTORY_SECONDS = 24 * 3600
+# Jobs queued on a timer, as a safety net for changes made outside the app, and how often
+PERIODIC_JOBS = {
+    "sales_rollup": 60,
+    "recommendations": RECOMMENDATION_REFRESH_SECONDS,
+    "maintenance": 3600,
+}
+
+def enqueue_job(cursor, kind, payload=None, dedupe_key=None, delay=0):
+    """Queue a job on the caller's cursor, so it commits or rolls back with the caller's transaction.
+
+    Call wake_job_workers() once that transaction has committed; a worker
+    woken before then would not see the job yet and go back to sleep.
+    """
+    now = time.time()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, dedupe_key, status, run_after, created_at)
+        VALUES (?, ?, ?, 'queued', ?, ?)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+    """, (kind, json.dumps(payload), dedupe_key, now + delay, now))
+
+@st.cache_resource
+def get_job_wakeup():
+    # Set when this process queues a job, so an idle worker picks it up without waiting out its poll
+    return threading.Event()
+
+def wake_job_workers():
+    get_job_wakeup().set()
+
+# The next due job, one range on the (status, run_after) index
+CLAIM_JOB_SQL = """
+    UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, heartbeat_at = ?
+    WHERE id = (
+        SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ?
+        ORDER BY run_after LIMIT 1
     )
-""")
-
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS purchases (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        product_id INTEGER,
-        quantity INTEGER,
-        date DATE,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (product_id) REFERENCES products (id)
+    RETURNING id, kind, payload, attempts
+"""
+# A running job whose worker stopped renewing its heartbeat, on the (status, heartbeat_at) index
+RECLAIM_JOB_SQL = """
+    UPDATE jobs SET attempts = attempts + 1, started_at = ?, heartbeat_at = ?
+    WHERE id = (
+        SELECT id FROM jobs WHERE status = 'running' AND heartbeat_at < ?
+        ORDER BY heartbeat_at LIMIT 1
     )
-""")
+    RETURNING id, kind, payload, attempts
+"""
+HOT_QUERIES["claim job"] = (CLAIM_JOB_SQL, (0, 0, 0))
+HOT_QUERIES["reclaim job"] = (RECLAIM_JOB_SQL, (0, 0, 0))
 
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS hosts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        password TEXT
-    )
-""")
+def claim_job():
+    now = time.time()
+    with get_cursor() as cursor:
+        cursor.execute(CLAIM_JOB_SQL, (now, now, now))
+        job = cursor.fetchone()
+        if job is None:
+            cursor.execute(RECLAIM_JOB_SQL, (now, now, now - JOB_LEASE_SECONDS))
+            job = cursor.fetchone()
+        return job
 
-conn.commit()
+def keep_job_alive(job_id, done):
+    # Renew the job's heartbeat until `done` is set, so a long run is not taken for a lost one
+    while not done.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with get_cursor() as cursor:
+                cursor.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+        except sqlite3.Error:
+            logger.exception("Renewing the heartbeat of job %s failed", job_id)
 
-# Add example purchases
-cursor.execute("SELECT COUNT(*) FROM purchases")
-if cursor.fetchone()[0] == 0:
-    example_purchases = [
-        (1, 1, 2, '2024-08-01'),
-        (2, 2, 1, '2024-08-02'),
-        (3, 3, 3, '2024-08-03')
-    ]
-    cursor.executemany("INSERT INTO purchases (user_id, product_id, quantity, date) VALUES (?, ?, ?, ?)", example_purchases)
-    conn.commit()
+def finish_job(job_id, kind, attempts, error=None):
+    now = time.time()
+    with get_cursor() as cursor:
+        if error is None:
+            cursor.execute("UPDATE jobs SET status = 'done', finished_at = ?, error = NULL WHERE id = ?", (now, job_id))
+            return
+        if attempts >= JOB_MAX_ATTEMPTS:
+            cursor.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?", (now, error, job_id))
+            return
+        try:
+            cursor.execute("""
+                UPDATE jobs SET status = 'queued', run_after = ?, error = ? WHERE id = ?
+            """, (now + JOB_RETRY_SECONDS * 2 ** (attempts - 1), error, job_id))
+        except sqlite3.IntegrityError:
+            # The same job was queued again meanwhile; that one will do the work
+            cursor.execute("UPDATE jobs SET status = 'superseded', finished_at = ?, error = ? WHERE id = ?", (now, error, job_id))
 
-# Global variables
-if 'current_user' not in st.session_state:
-    st.session_state.current_user = None
-if 'current_host' not in st.session_state:
-    st.session_state.current_host = None
-if 'page' not in st.session_state:
-    st.session_state.page = "Login"
+def run_jobs(wakeup):
+    while True:
+        try:
+            job = claim_job()
+        except sqlite3.Error:
+            logger.exception("Claiming a job failed")
+            job = None
+        if job is None:
+            wakeup.wait(timeout=1)
+            wakeup.clear()
+            continue
+        job_id, kind, payload, attempts = job
+        done = threading.Event()
+        threading.Thread(target=keep_job_alive, args=(job_id, done), name=f"jobs-heartbeat-{job_id}", daemon=True).start()
+        try:
+            JOB_HANDLERS[kind](**(json.loads(payload) or {}))
+        except Exception as error:
+            logger.exception("Job %s (%s) failed on attempt %s", job_id, kind, attempts)
+            finish_job(job_id, kind, attempts, repr(error))
+        else:
+            finish_job(job_id, kind, attempts)
+        finally:
+            done.set()
+
+def schedule_periodic_jobs():
+    due = {kind: 0 for kind in PERIODIC_JOBS}
+    while True:
+        now = time.time()
+        for kind, interval in PERIODIC_JOBS.items():
+            if now >= due[kind]:
+                try:
+                    with get_cursor() as cursor:
+                        enqueue_job(cursor, kind, dedupe_key=kind)
+                    wake_job_workers()
+                except sqlite3.Error:
+                    logger.exception("Scheduling %s failed", kind)
+                due[kind] = now + interval
+        time.sleep(min(PERIODIC_JOBS.values()) / 4)
+
+@st.cache_resource
+def start_job_workers():
+    # Once per process: the workers and the timer that queues periodic jobs
+    wakeup = get_job_wakeup()
+    threads = [threading.Thread(target=run_jobs, args=(wakeup,), name=f"jobs-{i}", daemon=True) for i in range(JOB_WORKERS)]
+    threads.append(threading.Thread(target=schedule_periodic_jobs, name="jobs-timer", daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads
+
+def record_order_confirmation(order_id):
+    # The confirmation for an order: who to notify and what they bought
+    with get_cursor() as cursor:
+        cursor.execute("SELECT o.user_id, u.email, o.total, o.created_at FROM orders o LEFT JOIN users u ON u.id = o.user_id WHERE o.id = ?", (order_id,))
+        order = cursor.fetchone()
+        if order is None:
+            return
+        cursor.execute("""
+            SELECT p.name, pu.quantity, pu.price
+            FROM purchases pu LEFT JOIN products p ON p.id = pu.product_id
+            WHERE pu.order_id = ?
+        """, (order_id,))
+        items = [{"product": name, "quantity": quantity, "price": price} for name, quantity, price in cursor.fetchall()]
+        user_id, email, total, created_at = order
+        cursor.execute("""
+            INSERT OR IGNORE INTO order_confirmations (order_id, user_id, email, total, items, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (order_id, user_id, email, total, json.dumps(items), created_at))
+
+def run_maintenance():
+    # Refresh planner statistics, merge the search index's segments, drop old job history and expired reservations
+    with get_cursor() as cursor:
+        cursor.execute("INSERT INTO products_fts(products_fts) VALUES ('optimize')")
+        cursor.execute("""
+            DELETE FROM jobs WHERE status IN ('done', 'superseded') AND finished_at < ?
+        """, (time.time() - JOB_HISTORY_SECONDS,))
+        cursor.execute("DELETE FROM stock_reservations WHERE expires_at <= ?", (time.time(),))
+        cursor.execute("PRAGMA optimize")
+
+JOB_HANDLERS = {
+    "sales_rollup": catch_up_sales_rollup,
+    "recommendations": catch_up_recommendations,
+    "order_confirmation": record_order_confirmation,
+    "maintenance": run_maintenance,
+}
+
+def job_metrics():
+    """Queue depth, wait and run times per job kind, for the Jobs tab."""
+    now = time.time()
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT kind,
+                   SUM(status = 'queued'), SUM(status = 'running'), SUM(status = 'failed'), SUM(status = 'done'),
+                   MAX(CASE WHEN status = 'queued' AND run_after <= ? THEN ? - run_after END),
+                   AVG(CASE WHEN status = 'done' THEN started_at - created_at END),
+                   AVG(CASE WHEN status = 'done' THEN finished_at - started_at END),
+                   SUM(attempts > 1)
+            FROM jobs GROUP BY kind ORDER BY kind
+        """, (now, now))
+        return cursor.fetchall()
+
+# Bulk import and export. Files are streamed in chunks so memory stays bounded
+# whatever their size; used by the host Products and Purchases page and by
+# `python app6.py import` / `python app6.py export`.
+BULK_TABLES = ("products", "purchases", "users")
+BULK_CHUNK_ROWS = 50000
+
+def bulk_format(file_name):
+    return "parquet" if file_name.lower().endswith((".parquet", ".pq")) else "csv"
+
+def table_columns(cursor, table):
+    # (name, declared type) of every column
+    cursor.execute(f'PRAGMA table_info("{table}")')
+    return [(row[1], row[2].upper()) for row in cursor.fetchall()]
+
+def is_numeric_column(declared):
+    return "INT" in declared or declared in ("REAL", "FLOAT", "DOUBLE")
+
+def read_chunks(source, file_format, chunk_rows):
+    """Yield (columns, rows) from a CSV or Parquet file, at most chunk_rows rows at a time.
+
+    `source` is a path or a binary file object. CSV fields arrive as text and
+    are converted by the column affinity; empty fields become NULL.
+    """
+    if file_format == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet files need pyarrow: pip install pyarrow")
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_rows):
+            columns = []
+            for field, column in zip(batch.schema, batch.columns):
+                # sqlite3 has no adapter for dates, so they go in as text like the rest of the table
+                if pa.types.is_temporal(field.type):
+                    column = column.cast(pa.string())
+                columns.append(column.to_pylist())
+            yield batch.schema.names, list(zip(*columns))
+        return
+
+    text = open(source, newline="", encoding="utf-8") if isinstance(source, str) else io.TextIOWrapper(source, encoding="utf-8", newline="")
+    with text:
+        reader = csv.reader(text)
+        columns = next(reader, None)
+        while columns:
+            rows = [tuple(value if value != "" else None for value in row) for row in itertools.islice(reader, chunk_rows)]
+            if not rows:
+                return
+            yield columns, rows
+
+def bulk_import(table, source, file_format, progress=None, chunk_rows=BULK_CHUNK_ROWS):
+    """Append the rows of a CSV or Parquet file to `table`; returns (rows, seconds).
+
+    The load is one transaction, so a bad row leaves the table as it was. The
+    table's indexes and triggers are dropped first and recreated once at the
+    end, and the new products are added to the search index in one statement,
+    instead of updating them row by row. `progress(rows, seconds)` is called after each
+    chunk.
+    """
+    if table not in BULK_TABLES:
+        raise ValueError(f"Bulk import is not supported for {table}")
+    started = time.perf_counter()
+    loaded = 0
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        known = {name for name, _ in table_columns(cursor, table)}
+        cursor.execute(f'SELECT COALESCE(MAX(id), 0), COUNT(*) FROM "{table}"')
+        last_id, existing = cursor.fetchone()
+
+        cursor.execute("""
+            SELECT name, type, sql FROM sqlite_master
+            WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+        """, (table,))
+        deferred = cursor.fetchall()
+        for name, kind, _ in deferred:
+            cursor.execute(f'DROP {kind.upper()} "{name}"')
+
+        for columns, rows in read_chunks(source, file_format, chunk_rows):
+            unknown = set(columns) - known
+            if unknown:
+                raise ValueError(f"{table} has no column {', '.join(sorted(unknown))}")
+            names = ", ".join(f'"{col}"' for col in columns)
+            placeholders = ", ".join("?" for _ in columns)
+            cursor.executemany(f'INSERT INTO "{table}" ({names}) VALUES ({placeholders})', rows)
+            loaded += len(rows)
+            if progress:
+                progress(loaded, time.perf_counter() - started)
+
+        for _, _, sql in deferred:
+            cursor.execute(sql)
+        # Usually the file only adds rows past the old maximum id, and the derived
+        # tables can catch up on just those; explicit lower ids mean starting over.
+        cursor.execute(f'SELECT COUNT(*) FROM "{table}" WHERE id <= ?', (last_id,))
+        appended = cursor.fetchone()[0] == existing
+        if table == "products" and appended:
+            cursor.execute("INSERT INTO products_fts (rowid, name, description) SELECT id, name, description FROM products WHERE id > ?", (last_id,))
+        elif table == "products":
+            cursor.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+        elif table == "purchases" and appended:
+            refresh_sales_rollup(cursor)
+        elif table == "purchases":
+            queue_sales_rollup_rebuild(cursor)
+            queue_recommendations_rebuild(cursor)
+    wake_job_workers()
+    if table == "products":
+        invalidate_catalog()
+    return loaded, time.perf_counter() - started
+
+def parquet_type(declared):
+    import pyarrow as pa
+    if "INT" in declared:
+        return pa.int64()
+    if is_numeric_column(declared):
+        return pa.float64()
+    return pa.string()
+
+def bulk_export(table, target, file_format, chunk_rows=BULK_CHUNK_ROWS):
+    """Write `table` to a CSV or Parquet file chunk by chunk and return the number of rows.
+
+    `target` is a path or a binary file object.
+    """
+    if table not in BULK_TABLES:
+        raise ValueError(f"Bulk export is not supported for {table}")
+    exported = 0
+    with get_cursor() as cursor:
+        columns = table_columns(cursor, table)
+        cursor.execute(f'SELECT * FROM "{table}" ORDER BY rowid')
+        chunks = iter(lambda: cursor.fetchmany(chunk_rows), [])
+
+        if file_format == "parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise RuntimeError("Parquet files need pyarrow: pip install pyarrow")
+            schema = pa.schema([(name, parquet_type(declared)) for name, declared in columns])
+            with pq.ParquetWriter(target, schema) as writer:
+                for rows in chunks:
+                    arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                    exported += len(rows)
+            return exported
+
+        text = open(target, "w", newline="", encoding="utf-8") if isinstance(target, str) else io.TextIOWrapper(target, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow([name for name, _ in columns])
+        for rows in chunks:
+            writer.writerows(rows)
+            exported += len(rows)
+        if isinstance(target, str):
+            text.close()
+        else:
+            # Leave the caller's file object open
+            text.flush()
+            text.detach()
+    return exported
+
+# Credentials. Passwords and restore phrases are stored as scrypt hashes in the
+# form scrypt$n$r$p$salt$hash. Raise the cost through the environment when the
+# server has CPU and memory to spare; older hashes are upgraded on next login.
+SCRYPT_N = int(os.environ.get("STORE_SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("STORE_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("STORE_SCRYPT_P", 1))
+
+# Failed logins allowed per username within LOGIN_WINDOW seconds; further tries are refused before hashing anything
+LOGIN_ATTEMPTS = 5
+LOGIN_WINDOW = 300
+# Usernames with recent failures kept in memory; past this, expired entries and then the oldest are dropped
+LOGIN_TRACKED_USERNAMES = 10000
+
+def scrypt(secret, salt, n, r, p):
+    return hashlib.scrypt(secret.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p + 2 ** 20)
+
+def hash_secret(secret):
+    salt = secrets.token_bytes(16)
+    digest = scrypt(secret, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def check_secret(stored, secret):
+    """Return (matches, needs_rehash) for a stored hash, or a plaintext value left by older versions."""
+    if not stored or secret is None:
+        return False, False
+    if not stored.startswith("scrypt$"):
+        return hmac.compare_digest(stored.encode(), secret.encode()), True
+    _, n, r, p, salt, digest = stored.split("$")
+    n, r, p = int(n), int(r), int(p)
+    matches = hmac.compare_digest(scrypt(secret, bytes.fromhex(salt), n, r, p).hex(), digest)
+    return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+def is_hashed(stored):
+    return bool(stored) and stored.startswith("scrypt$")
+
+@st.cache_resource
+def get_dummy_hash():
+    # Checked against when no account matches, so an unknown username costs as much as a wrong password
+    return hash_secret(secrets.token_hex(16))
+
+@st.cache_resource
+def get_login_failures():
+    # username -> times of recent failed attempts, shared by every session
+    return {"lock": threading.Lock(), "by_username": {}}
+
+def login_blocked(username):
+    failures = get_login_failures()
+    cutoff = time.time() - LOGIN_WINDOW
+    with failures["lock"]:
+        recent = [at for at in failures["by_username"].get(username, []) if at > cutoff]
+        if recent:
+            failures["by_username"][username] = recent
+        else:
+            failures["by_username"].pop(username, None)
+        return len(recent) >= LOGIN_ATTEMPTS
+
+def record_login_failure(username):
+    failures = get_login_failures()
+    now = time.time()
+    with failures["lock"]:
+        by_username = failures["by_username"]
+        if username not in by_username and len(by_username) >= LOGIN_TRACKED_USERNAMES:
+            # Guessing many usernames must not grow this without bound
+            for name in [name for name, times in by_username.items() if times[-1] <= now - LOGIN_WINDOW]:
+                del by_username[name]
+            while len(by_username) >= LOGIN_TRACKED_USERNAMES:
+                del by_username[next(iter(by_username))]
+        by_username.setdefault(username, []).append(now)
+
+def clear_login_failures(username):
+    failures = get_login_failures()
+    with failures["lock"]:
+        failures["by_username"].pop(username, None)
+
+def start_session(role, account):
+    # account is (id, username, email); it stays in server-side session state, which
+    # is all the pages need, so no row is re-read on later reruns and nothing goes in the URL
+    if role == "user":
+        st.session_state.current_user = account
+        st.session_state.page = "User Home"
+    else:
+        st.session_state.current_host = account
+        st.session_state.page = "Host Dashboard"
 
 # Define functions for user authentication
 def signup(username, password, email, restore_phrase):
+    password, restore_phrase = hash_secret(password), hash_secret(restore_phrase)
     try:
-        cursor.execute("INSERT INTO users (username, password, email, restore_phrase) VALUES (?,?,?,?)", (username, password, email, restore_phrase))
-        conn.commit()
-        cursor.execute("SELECT * FROM users WHERE username =?", (username,))
-        user = cursor.fetchone()
-        st.session_state.current_user = user
-        st.success("Account created successfully!")
-        return True
+        with get_cursor() as cursor:
+            cursor.execute("INSERT INTO users (username, password, email, restore_phrase) VALUES (?,?,?,?)", (username, password, email, restore_phrase))
+            user = (cursor.lastrowid, username, email)
     except sqlite3.IntegrityError:
         st.error("Username already exists")
         return False
+    start_session("user", user)
+    st.success("Account created successfully!")
+    return True
+
+def upgrade_credentials(role, account_id, stored_password, password, stored_phrase):
+    # Hash what is still plaintext, or hashed with old cost settings, now that the password is known.
+    # The old value is matched so a concurrent password change is not overwritten.
+    table = "users" if role == "user" else "hosts"
+    new_password = hash_secret(password)
+    new_phrase = hash_secret(stored_phrase) if stored_phrase and not is_hashed(stored_phrase) else None
+    with get_cursor() as cursor:
+        cursor.execute(f"UPDATE {table} SET password = ? WHERE id = ? AND password = ?", (new_password, account_id, stored_password))
+        if new_phrase:
+            cursor.execute("UPDATE users SET restore_phrase = ? WHERE id = ? AND restore_phrase = ?", (new_phrase, account_id, stored_phrase))
 
 def login(username, password):
-    cursor.execute("SELECT * FROM users WHERE username =? AND password =?", (username, password))
-    user = cursor.fetchone()
-    if user:
-        st.session_state.current_user = user
-        st.session_state.page = "User Home"
-        return True
+    if login_blocked(username):
+        st.error("Too many failed attempts. Please wait a few minutes and try again.")
+        return False
+    with get_cursor() as cursor:
+        cursor.execute("SELECT role, id, username, email, password, restore_phrase FROM accounts WHERE username = ?", (username,))
+        accounts = cursor.fetchall()
+    # Hashing happens after the connection is returned to the pool. A user and a
+    # host may share a username; the user account is tried first, as before.
+    for role, account_id, name, email, stored_password, stored_phrase in sorted(accounts, key=lambda account: account[0] == "host"):
+        matches, needs_rehash = check_secret(stored_password, password)
+        if matches:
+            break
     else:
-        cursor.execute("SELECT * FROM hosts WHERE username =? AND password =?", (username, password))
-        host = cursor.fetchone()
-        if host:
-            st.session_state.current_host = host
-            st.session_state.page = "Host Dashboard"
-            return True
-        else:
-            st.error("Invalid username or password")
-            return False
+        if not accounts:
+            check_secret(get_dummy_hash(), password)
+        record_login_failure(username)
+        st.error("Invalid username or password")
+        return False
+    if needs_rehash or (stored_phrase and not is_hashed(stored_phrase)):
+        upgrade_credentials(role, account_id, stored_password, password, stored_phrase)
+    clear_login_failures(username)
+    start_session(role, (account_id, name, email))
+    return True
 
 def change_password(new_password):
-    cursor.execute("UPDATE users SET password =? WHERE id =?", (new_password, st.session_state.current_user[0]))
-    conn.commit()
+    new_password = hash_secret(new_password)
+    with get_cursor() as cursor:
+        cursor.execute("UPDATE users SET password =? WHERE id =?", (new_password, st.session_state.current_user[0]))
     st.success("Password changed successfully!")
 
 def change_host_password(new_password):
-    cursor.execute("UPDATE hosts SET password =? WHERE id =?", (new_password, st.session_state.current_host[0]))
-    conn.commit()
+    new_password = hash_secret(new_password)
+    with get_cursor() as cursor:
+        cursor.execute("UPDATE hosts SET password =? WHERE id =?", (new_password, st.session_state.current_host[0]))
     st.success("Password changed successfully!")
 
+def reset_password(username, restore_phrase, new_password):
+    # Rate limited like login, since the restore phrase is a password too
+    if login_blocked(username):
+        return False
+    with get_cursor() as cursor:
+        cursor.execute("SELECT id, restore_phrase FROM users WHERE username = ?", (username,))
+        user = cursor.fetchone()
+    # Unknown usernames are hashed against too, so they take as long as a wrong phrase
+    matches, _ = check_secret(user[1] if user else get_dummy_hash(), restore_phrase)
+    if not user or not matches:
+        record_login_failure(username)
+        return False
+    new_password, new_phrase = hash_secret(new_password), hash_secret(restore_phrase)
+    with get_cursor() as cursor:
+        cursor.execute("UPDATE users SET password = ?, restore_phrase = ? WHERE id = ?", (new_password, new_phrase, user[0]))
+    clear_login_failures(username)
+    return True
+
 # Define page layouts
 def signup_page():
     st.markdown('<h1 class="centered-title">Sign Up</h1>', unsafe_allow_html=True)
@@ -202,6 +1674,7 @@ def signup_page():
             st.session_state.page = "User Home"
             st.rerun()
 
+@profiled_page
 def login_page():
     st.markdown('<h1 class="centered-title">Login</h1>', unsafe_allow_html=True)
     username = st.text_input("Username")
@@ -222,137 +1695,464 @@ def forgot_password_page():
     restore_phrase = st.text_input("Restore Phrase")
     new_password = st.text_input("New Password", type="password")
     if st.button("Reset Password"):
-        cursor.execute("SELECT * FROM users WHERE username =? AND restore_phrase =?", (username, restore_phrase))
-        user = cursor.fetchone()
-        if user:
-            cursor.execute("UPDATE users SET password =? WHERE id =?", (new_password, user[0]))
-            conn.commit()
+        if reset_password(username, restore_phrase, new_password):
             st.success("Password reset successfully!")
             st.session_state.page = "Login"
             st.rerun()
         else:
             st.error("Invalid username or restore phrase")
 
+# Stock. products.stock is what is left to sell, or NULL when it is not tracked.
+# Putting a tracked product in the cart reserves that quantity for
+# RESERVATION_TTL_SECONDS; checkout then takes it from stock with a conditional
+# UPDATE, so an expired reservation can still lose the race but never oversells.
+RESERVATION_TTL_SECONDS = 15 * 60
+
+# Stock of products.id held by other shoppers' live reservations; parameters are (user_id, now)
+RESERVED_BY_OTHERS = """
+    (SELECT COALESCE(SUM(r.quantity), 0) FROM stock_reservations r
+     WHERE r.product_id = products.id AND r.user_id != ? AND r.expires_at > ?)
+"""
+
+class OutOfStock(Exception):
+    """Raised by checkout, with nothing bought, when some cart lines want more than is left."""
+
+    def __init__(self, products):
+        super().__init__(", ".join(products))
+        self.products = products
+
+def reserve_stock(cursor, user_id, product_id, quantity):
+    """Hold `quantity` of a product for the user's cart; returns False if that much is not free.
+
+    Replaces the user's previous reservation of the product, and a quantity
+    of 0 releases it. Products without tracked stock always succeed. Call it
+    inside a BEGIN IMMEDIATE transaction together with the cart change.
+    """
+    cursor.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return True
+    if quantity <= 0:
+        cursor.execute("DELETE FROM stock_reservations WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+        return True
+    now = time.time()
+    cursor.execute(f"""
+        INSERT INTO stock_reservations (user_id, product_id, quantity, expires_at)
+        SELECT ?, id, ?, ? FROM products
+        WHERE id = ? AND stock - {RESERVED_BY_OTHERS} >= ?
+        ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = excluded.quantity, expires_at = excluded.expires_at
+    """, (user_id, quantity, now + RESERVATION_TTL_SECONDS, product_id, user_id, now, quantity))
+    return cursor.rowcount > 0
+
+def add_to_cart(user_id, product_id):
+    """Put one more of a product in the user's cart; returns False, changing nothing, if it is out of stock."""
+    # Adding a product already in the cart bumps its quantity instead of adding a row
+    with get_cursor() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT quantity FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+        row = cursor.fetchone()
+        if not reserve_stock(cursor, user_id, product_id, (row[0] if row else 0) + 1):
+            return False
+        cursor.execute("""
+            INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, 1)
+            ON CONFLICT (user_id, product_id) DO UPDATE SET quantity = quantity + 1
+        """, (user_id, product_id))
+    return True
+
 def create_product_card(product):
     col1, col2 = st.columns([1, 3])
     with col1:
-        # Image placeholder
-        img = Image.new('RGB', (100, 100), color='gray')
-        st.image(img, use_column_width=True)
+        st.image(product_image(product[0], 100), use_column_width=True)
     with col2:
         st.subheader(product[1])
         st.write(f"${product[2]:.2f}")
         st.write(product[4])  # Description
-        if st.button(f"Add to Cart {product[1]}"):
-            cursor.execute("INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)", (st.session_state.current_user[0], product[0], 1))
-            conn.commit()
-            st.success(f"Added {product[1]} to cart")
+        also_bought = load_also_bought_names(product[0], catalog_generation())
+        if also_bought:
+            st.caption("Customers also bought: " + ", ".join(also_bought))
+        add_to_cart_button(product[0], product[1])
+
+# A click reruns only this button, not the page listing the products
+@st.fragment
+@profiled_page
+def add_to_cart_button(product_id, name, label=None):
+    if st.button(label or f"Add to Cart {name}"):
+        if add_to_cart(st.session_state.current_user[0], product_id):
+            st.success(f"Added {name} to cart")
+        else:
+            st.warning(f"Sorry, {name} is out of stock")
+
+def fetch_product_page(after_id, page_size):
+    """Return the next `page_size` non-popular products after `after_id` and whether more follow.
+
+    Pages are seeked on `products.id` through the (is_popular, id) index, so
+    every page costs the same however deep into the catalog it is.
+    """
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT id, name, price, is_popular, description FROM products
+            WHERE is_popular = 0 AND id > ?
+            ORDER BY id LIMIT ?
+        """, (after_id, page_size + 1))
+        products = cursor.fetchall()
+    return products[:page_size], len(products) > page_size
+
+@st.cache_data(ttl=CATALOG_CACHE_TTL, max_entries=1000, show_spinner=False)
+def load_product_page(after_id, page_size, generation):
+    return fetch_product_page(after_id, page_size)
+
+# Recommendation reads are cached only as long as one background refresh takes to change them
+@st.cache_data(ttl=RECOMMENDATION_REFRESH_SECONDS, show_spinner=False)
+def load_popular_products(generation):
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT p.id, p.name, p.price, p.is_popular, p.description
+            FROM product_popularity pp JOIN products p ON p.id = pp.product_id
+            ORDER BY pp.score DESC LIMIT ?
+        """, (POPULAR_PRODUCTS,))
+        products = cursor.fetchall()
+        # The hand-picked products always follow the top sellers: the Products tab
+        # and search leave them out, so this is the only place shoppers reach them
+        cursor.execute("SELECT id, name, price, is_popular, description FROM products WHERE is_popular = 1")
+        shown = {product[0] for product in products}
+        products += [product for product in cursor.fetchall() if product[0] not in shown]
+    return products
+
+def load_featured_product(generation):
+    # The most popular product, as (id, name, price, description)
+    products = load_popular_products(generation)
+    return (products[0][0], products[0][1], products[0][2], products[0][4]) if products else None
+
+@st.cache_data(ttl=RECOMMENDATION_REFRESH_SECONDS, max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def load_also_bought(product_id, limit, generation):
+    # [(other product id, weight)] for the products most often bought with product_id
+    with get_cursor() as cursor:
+        cursor.execute("SELECT other_id, weight FROM product_pairs WHERE product_id = ? ORDER BY weight DESC LIMIT ?", (product_id, limit))
+        return cursor.fetchall()
+
+@st.cache_data(ttl=RECOMMENDATION_REFRESH_SECONDS, max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def load_also_bought_names(product_id, generation):
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT p.name FROM product_pairs pp JOIN products p ON p.id = pp.other_id
+            WHERE pp.product_id = ? ORDER BY pp.weight DESC LIMIT 3
+        """, (product_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+def fetch_products(product_ids):
+    # Product rows for the ids, in the order given
+    if not product_ids:
+        return []
+    with get_cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id, name, price, is_popular, description FROM products
+            WHERE id IN ({", ".join("?" for _ in product_ids)})
+        """, tuple(product_ids))
+        rows = {row[0]: row for row in cursor.fetchall()}
+    return [rows[product_id] for product_id in product_ids if product_id in rows]
+
+@st.cache_data(ttl=RECOMMENDATION_REFRESH_SECONDS, show_spinner=False)
+def load_recommendations(user_id, generation):
+    """Products bought together with the user's recent purchases, best first.
 
+    Each recent product contributes its top pairs from one index lookup, so
+    the cost depends on how many are asked for, not on the purchase history.
+    """
+    with get_cursor() as cursor:
+        cursor.execute("SELECT product_id FROM purchases WHERE user_id = ? ORDER BY date DESC LIMIT ?", (user_id, POPULAR_PRODUCTS))
+        recent = {row[0] for row in cursor.fetchall()}
+    weights = collections.Counter()
+    for product_id in recent:
+        for other_id, weight in load_also_bought(product_id, POPULAR_PRODUCTS, generation):
+            if other_id not in recent:
+                weights[other_id] += weight
+    return fetch_products([product_id for product_id, _ in weights.most_common(RECOMMENDED_PRODUCTS)])
+
+def fts_query(search_query):
+    # Quote every word of the search box and prefix-match it, so "lap ph" finds "Laptop Phone"
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", search_query))
+
+# Product search ranks inside products_fts and only joins the top of the ranking
+# to products, instead of joining every match before the LIMIT
+PRODUCT_SEARCH_SQL = """
+    SELECT p.id, p.name, p.price, p.is_popular, p.description
+    FROM (
+        SELECT rowid, bm25(products_fts, 10.0, 1.0) AS score FROM products_fts
+        WHERE products_fts MATCH ?
+        ORDER BY score, rowid LIMIT ?
+    ) AS ranked
+    JOIN products p ON p.id = ranked.rowid
+    ORDER BY ranked.score, p.id
+"""
+HOT_QUERIES["product search"] = (PRODUCT_SEARCH_SQL, ('"x"*', 42))
+
+def search_products(search_query, page_size, offset=0):
+    """Return a page of non-popular products matching `search_query` and whether more follow.
+
+    Matches come from the products_fts index and are ranked by BM25, with
+    hits in the name weighted above hits in the description. Twice the rows
+    needed are ranked, and more only if popular products took too many of them.
+    """
+    needed = offset + page_size + 1
+    limit = 2 * needed
+    with get_cursor() as cursor:
+        while True:
+            cursor.execute(PRODUCT_SEARCH_SQL, (fts_query(search_query), limit))
+            ranked = cursor.fetchall()
+            products = [product for product in ranked if not product[3]]
+            if len(products) >= needed or len(ranked) < limit:
+                break
+            limit *= 2
+    products = products[offset:]
+    return products[:page_size], len(products) > page_size
+
+@profiled_page
 def products_page():
     st.markdown('<h1 class="centered-title">Products</h1>', unsafe_allow_html=True)
-    search_query = st.text_input("Search products")
-    if search_query:
-        cursor.execute("SELECT id, name, price, is_popular, description FROM products WHERE name LIKE ? AND is_popular = 0", ('%'+search_query+'%',))
+    search_col, size_col = st.columns([3, 1])
+    with search_col:
+        search_query = st.text_input("Search products")
+    with size_col:
+        page_size = st.selectbox("Products per page", [10, 20, 50, 100], index=[10, 20, 50, 100].index(PRODUCTS_PAGE_SIZE))
+    searching = bool(fts_query(search_query))
+
+    # Keep a stack of where each visited page starts (last id seen when browsing,
+    # row offset when searching); start over when the listing changes
+    if st.session_state.get("products_listing") != (search_query, page_size):
+        st.session_state.products_listing = (search_query, page_size)
+        st.session_state.products_page_starts = [0]
+    page_starts = st.session_state.products_page_starts
+
+    if searching:
+        products, has_next = search_products(search_query, page_size, page_starts[-1])
     else:
-        cursor.execute("SELECT id, name, price, is_popular, description FROM products WHERE is_popular = 0")
-    products = cursor.fetchall()
+        products, has_next = load_product_page(page_starts[-1], page_size, catalog_generation())
+    if searching and not products:
+        st.write("No products match your search.")
     for product in products:
         create_product_card(product)
 
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        if st.button("Previous page", disabled=len(page_starts) == 1):
+            page_starts.pop()
+            st.rerun()
+    with page_col:
+        st.write(f"Page {len(page_starts)}")
+    with next_col:
+        if st.button("Next page", disabled=not has_next):
+            page_starts.append(page_starts[-1] + page_size if searching else products[-1][0])
+            st.rerun()
+
+@profiled_page
 def popular_products_page():
     st.markdown('<h1 class="centered-title">Popular Products</h1>', unsafe_allow_html=True)
-    cursor.execute("SELECT id, name, price, is_popular, description FROM products WHERE is_popular = 1")
-    popular_products = cursor.fetchall()
+    popular_products = load_popular_products(catalog_generation())
     for product in popular_products:
         create_product_card(product)
 
 def update_cart_quantity(user_id, product_id, new_quantity):
-    if new_quantity > 0:
-        cursor.execute("UPDATE cart SET quantity = ? WHERE user_id = ? AND product_id = ?", (new_quantity, user_id, product_id))
-    else:
-        cursor.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
-    conn.commit()
+    # Returns False, leaving the cart as it was, when the new quantity is more than the stock left
+    with get_cursor() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        if not reserve_stock(cursor, user_id, product_id, new_quantity):
+            return False
+        if new_quantity > 0:
+            cursor.execute("UPDATE cart SET quantity = ? WHERE user_id = ? AND product_id = ?", (new_quantity, user_id, product_id))
+        else:
+            cursor.execute("DELETE FROM cart WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+    return True
 
-def cart_page():
-    st.markdown('<h1 class="centered-title">Cart</h1>', unsafe_allow_html=True)
-    cursor.execute("""
-        SELECT p.id, p.name, p.price, c.quantity 
-        FROM cart c 
-        JOIN products p ON c.product_id = p.id 
-        WHERE c.user_id = ?
-    """, (st.session_state.current_user[0],))
-    cart_items = cursor.fetchall()
+def checkout(user_id, token):
+    """Turn the user's cart into an order and return the amount paid, or None if the cart is empty.
+
+    Runs as a single BEGIN IMMEDIATE transaction: the order total, the
+    purchases (with the price at purchase time) and the emptied cart all
+    come from the same snapshot, whatever the cart size. Replaying a token
+    that already went through returns that order's total instead of buying
+    again. Tracked stock is taken with one conditional UPDATE that skips
+    any line wanting more than is left after other shoppers' reservations;
+    if it skipped any, the transaction is rolled back and OutOfStock names
+    those products. The sales rollup, recommendations and order
+    confirmation are queued as jobs in the same transaction rather than
+    done here.
+    """
+    with get_cursor() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT total FROM orders WHERE token = ?", (token,))
+        order = cursor.fetchone()
+        if order:
+            return order[0]
+        cursor.execute("""
+            SELECT COUNT(*), SUM(c.quantity * p.price)
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = ?
+        """, (user_id,))
+        line_count, total = cursor.fetchone()
+        if not line_count:
+            return None
+        cursor.execute("""
+            SELECT COUNT(*) FROM cart c JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = ? AND p.stock IS NOT NULL
+        """, (user_id,))
+        tracked_lines = cursor.fetchone()[0]
+        if tracked_lines:
+            now_ts = time.time()
+            cursor.execute(f"""
+                UPDATE products SET stock = products.stock - c.quantity
+                FROM cart c
+                WHERE c.user_id = ? AND c.product_id = products.id AND products.stock IS NOT NULL
+                  AND products.stock - {RESERVED_BY_OTHERS} >= c.quantity
+            """, (user_id, user_id, now_ts))
+            if cursor.rowcount < tracked_lines:
+                # Undo the lines already taken, then name the ones that fell short
+                cursor.execute("ROLLBACK")
+                cursor.execute(f"""
+                    SELECT products.name FROM cart c JOIN products ON c.product_id = products.id
+                    WHERE c.user_id = ? AND products.stock - {RESERVED_BY_OTHERS} < c.quantity
+                """, (user_id, user_id, now_ts))
+                raise OutOfStock([row[0] for row in cursor.fetchall()])
+            cursor.execute("DELETE FROM stock_reservations WHERE user_id = ?", (user_id,))
+        now = datetime.datetime.now().isoformat(sep=" ")
+        cursor.execute("INSERT INTO orders (token, user_id, total, created_at) VALUES (?, ?, ?, ?)", (token, user_id, total, now))
+        order_id = cursor.lastrowid
+        cursor.execute("""
+            INSERT INTO purchases (user_id, product_id, quantity, price, date, order_id)
+            SELECT c.user_id, c.product_id, c.quantity, p.price, ?, ?
+            FROM cart c
+            JOIN products p ON c.product_id = p.id
+            WHERE c.user_id = ?
+        """, (now, order_id, user_id))
+        cursor.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
+        # Everything else that follows from the order happens in the background
+        enqueue_job(cursor, "sales_rollup", dedupe_key="sales_rollup")
+        enqueue_job(cursor, "recommendations", dedupe_key="recommendations")
+        enqueue_job(cursor, "order_confirmation", {"order_id": order_id}, dedupe_key=f"order_confirmation:{order_id}")
+    wake_job_workers()
+    return total
+
+def show_cart_total(placeholder):
+    total_cost = sum(price * quantity for price, quantity in st.session_state.cart_lines.values())
+    placeholder.subheader(f"Total Cost: ${total_cost:.2f}")
+
+def set_cart_quantity(product_id, key):
+    new_quantity = st.session_state[key]
+    price, quantity = st.session_state.cart_lines[product_id]
+    if not update_cart_quantity(st.session_state.current_user[0], product_id, new_quantity):
+        # Not enough stock: put the input back and let the line say why
+        st.session_state[key] = quantity
+        st.session_state.cart_stock_warning = product_id
+        return
+    st.session_state.cart_lines[product_id] = (price, new_quantity)
+    st.session_state.cart_total_stale = True
+
+@st.fragment
+@profiled_page
+def cart_line(product_id, name, total_placeholder):
+    price, quantity = st.session_state.cart_lines[product_id]
+    if quantity == 0:
+        # Removed from the cart; the total still has to drop the line
+        if st.session_state.pop("cart_total_stale", False):
+            show_cart_total(total_placeholder)
+        return
+    col1, col2, col3 = st.columns([1, 2, 1])
+    
+    with col1:
+        st.image(product_image(product_id, 100), use_column_width=True)
     
-    total_cost = 0
+    with col2:
+        st.subheader(name)
+        st.write(f"Price: ${price:.2f}")
+        st.write(f"Quantity: {quantity}")
+        st.write(f"Subtotal: ${price * quantity:.2f}")
     
-    for index, item in enumerate(cart_items):
-        product_id, name, price, quantity = item
-        col1, col2, col3 = st.columns([1, 2, 1])
-        
-        with col1:
-            # Image placeholder
-            img = Image.new('RGB', (100, 100), color='gray')
-            st.image(img, use_column_width=True)
-        
-        with col2:
-            st.subheader(name)
-            st.write(f"Price: ${price:.2f}")
-            st.write(f"Quantity: {quantity}")
-            st.write(f"Subtotal: ${price * quantity:.2f}")
-        
-        with col3:
-            new_quantity = st.number_input(f"Update quantity for {name}", min_value=0, value=quantity, step=1, key=f"quantity_{index}_{product_id}")
-            if new_quantity != quantity:
-                update_cart_quantity(st.session_state.current_user[0], product_id, new_quantity)
-                st.rerun()
-        
-        total_cost += price * quantity
-        st.divider()
+    with col3:
+        key = f"quantity_{product_id}"
+        st.number_input(f"Update quantity for {name}", min_value=0, value=quantity, step=1, key=key,
+                        on_change=set_cart_quantity, args=(product_id, key))
+        if st.session_state.get("cart_stock_warning") == product_id:
+            del st.session_state.cart_stock_warning
+            st.warning("Not enough stock for that quantity")
     
-    st.subheader(f"Total Cost: ${total_cost:.2f}")
+    st.divider()
+    if st.session_state.pop("cart_total_stale", False):
+        show_cart_total(total_placeholder)
+
+@profiled_page
+def cart_page():
+    st.markdown('<h1 class="centered-title">Cart</h1>', unsafe_allow_html=True)
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT p.id, p.name, p.price, c.quantity 
+            FROM cart c 
+            JOIN products p ON c.product_id = p.id 
+            WHERE c.user_id = ?
+        """, (st.session_state.current_user[0],))
+        cart_items = cursor.fetchall()
+    
+    # Lines and total live in session state so a quantity change reruns only
+    # its own line fragment, which then rewrites the total in place.
+    st.session_state.cart_lines = {product_id: (price, quantity) for product_id, _, price, quantity in cart_items}
+    lines = st.container()
+    total_placeholder = st.empty()
+    with lines:
+        for product_id, name, _, _ in cart_items:
+            cart_line(product_id, name, total_placeholder)
+    show_cart_total(total_placeholder)
     
+    # Identifies this checkout attempt; a new one is issued once it goes through
+    if 'checkout_token' not in st.session_state:
+        st.session_state.checkout_token = uuid.uuid4().hex
+
     if st.button("Purchase"):
-        for item in cart_items:
-            product_id, _, _, quantity = item
-            cursor.execute("INSERT INTO purchases (user_id, product_id, quantity, date) VALUES (?, ?, ?, ?)",
-            (st.session_state.current_user[0], product_id, quantity, datetime.datetime.now()))
-        cursor.execute("DELETE FROM cart WHERE user_id = ?", (st.session_state.current_user[0],))
-        conn.commit()
-        st.success(f"Purchase successful! Total amount paid: ${total_cost:.2f}")
-        st.balloons()
+        try:
+            total_paid = checkout(st.session_state.current_user[0], st.session_state.checkout_token)
+        except OutOfStock as error:
+            st.error(f"Not enough stock left for: {error}. Please lower the quantity and try again.")
+            return
+        st.session_state.checkout_token = uuid.uuid4().hex
+        if total_paid is None:
+            st.warning("Your cart is empty.")
+        else:
+            st.success(f"Purchase successful! Total amount paid: ${total_paid:.2f}")
+            st.balloons()
 
+@profiled_page
 def user_home_page():
     st.markdown('<h1 class="centered-title">Welcome, {}</h1>'.format(st.session_state.current_user[1]), unsafe_allow_html=True)
     
-    cursor.execute("SELECT id, name, price, description FROM products WHERE is_popular = 1 LIMIT 1")
-    popular_product = cursor.fetchone()
+    popular_product = load_featured_product(catalog_generation())
     
     if popular_product:
         col1, col2 = st.columns(2)
         with col1:
-            # Image placeholder
-            img = Image.new('RGB', (400, 400), color='gray')
-            st.image(img, use_column_width=True)
+            st.image(product_image(popular_product[0], 400), use_column_width=True)
         with col2:
             st.subheader(popular_product[1])
             st.write(popular_product[3])  # Description
             st.write(f"Price: ${popular_product[2]:.2f}")
-            if st.button("Add to Cart"):
-                cursor.execute("INSERT INTO cart (user_id, product_id, quantity) VALUES (?, ?, ?)", (st.session_state.current_user[0], popular_product[0], 1))
-                conn.commit()
-                st.success(f"Added {popular_product[1]} to cart")
+            add_to_cart_button(popular_product[0], popular_product[1], "Add to Cart")
     else:
         st.write("No popular products available at the moment.")
 
+    recommended = [product for product in load_recommendations(st.session_state.current_user[0], catalog_generation())
+                   if not popular_product or product[0] != popular_product[0]]
+    if recommended:
+        st.subheader("Recommended for you")
+        for product in recommended:
+            create_product_card(product)
+
 def hex_to_rgba(hex_code, alpha=1.0):
     hex_code = hex_code.lstrip('#')
     rgb = tuple(int(hex_code[i:i+2], 16) for i in (0, 2, 4))
     return f"rgba({rgb[0]}, {rgb[1]}, {rgb[2]}, {alpha})"
 
+@profiled_page
 def user_profile_page():
     st.markdown('<h1 class="centered-title">User Profile</h1>', unsafe_allow_html=True)
     st.write(f"Username: {st.session_state.current_user[1]}")
-    st.write(f"Email: {st.session_state.current_user[3]}")
+    st.write(f"Email: {st.session_state.current_user[2]}")
     st.subheader("Change Password")
     new_password = st.text_input("New Password", type="password")
     if st.button("Change Password"):
@@ -377,46 +2177,137 @@ def contact_page():
     st.write("Phone: (555) 123-4567")
     st.write("Instagram: @myapp_official")
 
+# Dashboard chart buckets, as SQL over the rollups' day; hours are read from the raw purchases
+GRANULARITIES = {
+    "Hour": None,
+    "Day": "s.day",
+    "Week": "strftime('%Y-%m-%d', s.day, 'weekday 0', '-6 days')",
+    "Month": "strftime('%Y-%m-01', s.day)",
+}
+HOURLY_MAX_DAYS = 31
+MAX_CHART_POINTS = 500
+
+def sales_filter(product_ids, all_product_ids, customer_ids, all_customer_ids, first_day, last_day, alias="s", date_column="day"):
+    # WHERE clause for the dashboard filters; a filter that selects everything is left out.
+    # The date range is half-open on the following day, so it also works on full timestamps.
+    clauses = [f"{alias}.{date_column} >= ? AND {alias}.{date_column} < ?"]
+    params = [first_day.isoformat(), (last_day + datetime.timedelta(days=1)).isoformat()]
+    for column, selected, options in (("product_id", product_ids, all_product_ids), ("user_id", customer_ids, all_customer_ids)):
+        if set(selected) != set(options):
+            clauses.append(f"{alias}.{column} IN ({', '.join('?' for _ in selected)})")
+            params.extend(selected)
+    return " WHERE " + " AND ".join(clauses), params
+
+def sales_rollups_for(products_narrowed, customers_narrowed):
+    """Return the rollups to read for the totals and for the sales-by-product chart.
+
+    The product×customer rollup is only needed when the customer filter is
+    narrowed as well as the product filter, or for the by-product chart
+    once customers are narrowed.
+    """
+    if customers_narrowed:
+        return ("sales_daily" if products_narrowed else "sales_daily_customer"), "sales_daily"
+    return "sales_daily_product", "sales_daily_product"
+
+@st.cache_data(ttl=60, max_entries=4)
+def load_sales_filter_options(generation, rollup_mark):
+    # {id: name} of the products and customers with sales, read again once the catalog or the rollups move on
+    with get_cursor() as cursor:
+        cursor.execute("SELECT id, name FROM products WHERE id IN (SELECT product_id FROM sales_daily_product) ORDER BY name")
+        product_names = dict(cursor.fetchall())
+        cursor.execute("SELECT id, username FROM users WHERE id IN (SELECT user_id FROM sales_daily_customer) ORDER BY username")
+        customer_names = dict(cursor.fetchall())
+    return product_names, customer_names
+
+def lttb_indices(xs, ys, threshold):
+    """Indices of at most `threshold` points that keep the shape of the series.
+
+    Largest-Triangle-Three-Buckets: keeps the first and last points and,
+    from each bucket in between, the point forming the largest triangle
+    with the point kept before it and the average of the next bucket.
+    """
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+    bucket_size = (count - 2) / (threshold - 2)
+    selected = [0]
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        next_x = sum(xs[end:next_end]) / (next_end - end)
+        next_y = sum(ys[end:next_end]) / (next_end - end)
+        kept = selected[-1]
+        selected.append(max(range(start, end), key=lambda i: abs(
+            (xs[kept] - next_x) * (ys[i] - ys[kept]) - (xs[kept] - xs[i]) * (next_y - ys[kept]))))
+    selected.append(count - 1)
+    return selected
+
+@profiled_page
 def host_dashboard_page():
+    import pandas as pd
+    import plotly.express as px
     st.markdown('<h1 class="centered-title">Host Dashboard</h1>', unsafe_allow_html=True)
     
-    # Read data from database
-    df = pd.read_sql_query("""
-        SELECT p.name as Product, pu.date as Date, pu.quantity as Quantity, p.price as Price, u.username as Customer
-        FROM purchases pu
-        JOIN products p ON pu.product_id = p.id
-        JOIN users u ON pu.user_id = u.id
-    """, conn)
-    
-    df['Total'] = df['Quantity'] * df['Price']
-    df['Date'] = pd.to_datetime(df['Date'])
+    # The sales_rollup job folds new purchases into the rollups; say so while it is behind
+    with get_cursor() as cursor:
+        cursor.execute("SELECT COALESCE((SELECT last_purchase_id FROM rollup_state WHERE name = 'sales_daily'), 0)")
+        rollup_mark = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM purchases WHERE id > ?", (rollup_mark,))
+        pending = cursor.fetchone()[0]
+    if pending:
+        st.caption(f"{pending:,} recent purchases are still being added to these figures.")
+    product_names, customer_names = load_sales_filter_options(catalog_generation(), rollup_mark)
     
     # Sidebar filters
     st.sidebar.header("Please Filter Here:")
     product = st.sidebar.multiselect(
         "Select the Product:",
-        options=df["Product"].unique(),
-        default=df["Product"].unique()
+        options=list(product_names),
+        default=list(product_names),
+        format_func=product_names.get,
     )
 
     customer = st.sidebar.multiselect(
         "Select the Customer:",
-        options=df["Customer"].unique(),
-        default=df["Customer"].unique(),
+        options=list(customer_names),
+        default=list(customer_names),
+        format_func=customer_names.get,
     )
 
-    df_selection = df.query(
-        "Product == @product & Customer == @customer"
-    )
+    with get_cursor() as cursor:
+        # Separate subqueries, so each is a single seek on the rollup's (day, ...) key
+        cursor.execute("SELECT (SELECT MIN(day) FROM sales_daily_product), (SELECT MAX(day) FROM sales_daily_product)")
+        first_sale, last_sale = cursor.fetchone()
+    if first_sale is None:
+        st.warning("No data available based on the current filter settings!")
+        st.stop()
+    first_sale, last_sale = datetime.date.fromisoformat(first_sale), datetime.date.fromisoformat(last_sale)
+    day_range = st.sidebar.date_input("Select the Dates:", value=(first_sale, last_sale))
+    # While only the start of a new range has been picked, show that single day
+    first_day, last_day = (day_range[0], day_range[-1]) if day_range else (first_sale, last_sale)
+    granularity = st.sidebar.selectbox("Group Sales by:", list(GRANULARITIES), index=1)
+    if granularity == "Hour" and (last_day - first_day).days >= HOURLY_MAX_DAYS:
+        st.sidebar.caption(f"Hourly sales cover at most {HOURLY_MAX_DAYS} days; showing daily sales.")
+        granularity = "Day"
+
+    # Check if the selection is empty:
+    if not product or not customer:
+        st.warning("No data available based on the current filter settings!")
+        st.stop() # This will halt the app from further execution.
 
-    # Check if the dataframe is empty:
-    if df_selection.empty:
+    where, params = sales_filter(product, list(product_names), customer, list(customer_names), first_day, last_day)
+    rollup, by_product_rollup = sales_rollups_for(set(product) != set(product_names), set(customer) != set(customer_names))
+    with get_cursor() as cursor:
+        cursor.execute(f"SELECT SUM(s.revenue), SUM(s.orders) FROM {rollup} s{where}", params)
+        revenue, orders = cursor.fetchone()
+    if not orders:
         st.warning("No data available based on the current filter settings!")
         st.stop() # This will halt the app from further execution.
 
     # TOP KPI's
-    total_sales = int(df_selection["Total"].sum())
-    average_sale_by_transaction = round(df_selection["Total"].mean(), 2)
+    total_sales = int(revenue)
+    average_sale_by_transaction = round(revenue / orders, 2)
 
     left_column, right_column = st.columns(2)
     with left_column:
@@ -429,7 +2320,14 @@ def host_dashboard_page():
     st.markdown("""---""")
 
     # SALES BY PRODUCT [BAR CHART]
-    sales_by_product = df_selection.groupby(by=["Product"])[["Total"]].sum().sort_values(by="Total")
+    with get_profiler().section("pandas"):
+        sales_by_product = pd.read_sql_query(f"""
+            SELECT p.name AS Product, SUM(s.revenue) AS Total
+            FROM {by_product_rollup} s
+            JOIN products p ON s.product_id = p.id{where}
+            GROUP BY p.name
+            ORDER BY Total
+        """, get_engine(), params=tuple(params), index_col="Product")
     fig_product_sales = px.bar(
         sales_by_product,
         x="Total",
@@ -445,17 +2343,40 @@ def host_dashboard_page():
     )
 
     # SALES BY DATE [LINE CHART]
-    sales_by_date = df_selection.groupby(by=["Date"])[["Total"]].sum()
+    # Bucketed in SQL; the rollup has whole days, so hours come from the date-indexed purchases
+    if GRANULARITIES[granularity] is None:
+        hour_where, hour_params = sales_filter(product, list(product_names), customer, list(customer_names),
+                                               first_day, last_day, alias="pu", date_column="date")
+        sales_by_date_sql = f"""
+            SELECT strftime('%Y-%m-%d %H:00:00', pu.date) AS Date, SUM(pu.quantity * COALESCE(pu.price, p.price)) AS Total
+            FROM purchases pu JOIN products p ON pu.product_id = p.id JOIN users u ON pu.user_id = u.id{hour_where}
+            GROUP BY 1
+            ORDER BY 1
+        """
+        sales_by_date_params = hour_params
+    else:
+        sales_by_date_sql = f"""
+            SELECT {GRANULARITIES[granularity]} AS Date, SUM(s.revenue) AS Total
+            FROM {rollup} s{where}
+            GROUP BY 1
+            ORDER BY 1
+        """
+        sales_by_date_params = params
+    with get_profiler().section("pandas"):
+        sales_by_date = pd.read_sql_query(sales_by_date_sql, get_engine(), params=tuple(sales_by_date_params),
+                                          index_col="Date", parse_dates=["Date"])
+    if len(sales_by_date) > MAX_CHART_POINTS:
+        keep = lttb_indices([moment.timestamp() for moment in sales_by_date.index], list(sales_by_date["Total"]), MAX_CHART_POINTS)
+        sales_by_date = sales_by_date.iloc[keep]
     fig_daily_sales = px.line(
         sales_by_date,
         x=sales_by_date.index,
         y="Total",
-        title="<b>Sales by Date</b>",
+        title=f"<b>Sales by {granularity}</b>",
         color_discrete_sequence=["#0083B8"],
         template="plotly_white",
     )
     fig_daily_sales.update_layout(
-        xaxis=dict(tickmode="linear"),
         plot_bgcolor="rgba(0,0,0,0)",
         yaxis=(dict(showgrid=False)),
     )
@@ -464,42 +2385,319 @@ def host_dashboard_page():
     left_column.plotly_chart(fig_daily_sales, use_container_width=True)
     right_column.plotly_chart(fig_product_sales, use_container_width=True)
 
-engine = create_engine('sqlite:///mydatabase.db')
+def _to_sql_value(value):
+    # Convert numpy/pandas scalars coming out of a DataFrame into plain Python values
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat(sep=" ")
+    return value
+
+def changes_rolled_up_sales(cursor, table, updates, deletes):
+    """Whether editor changes to `table` alter sales the rollups already hold.
+
+    Any purchases change does. Products and customers only count through
+    their purchases: a new price for products bought before purchases kept
+    their own price, or deleting a product or customer who has purchases.
+    Call it after applying the changes, on the same transaction.
+    """
+    if table == "purchases":
+        return True
+    if table not in ("products", "users"):
+        return False
+    column = "product_id" if table == "products" else "user_id"
+    checks = [([key for key, in deletes], "")]
+    if table == "products":
+        # Only legacy purchases without a price of their own take the product's current price
+        checks.append(([params[-1] for cols, rows in updates.items() if "price" in cols for params in rows], " AND price IS NULL"))
+    for ids, condition in checks:
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f"SELECT 1 FROM purchases WHERE {column} IN ({', '.join('?' for _ in chunk)}){condition} LIMIT 1", chunk)
+            if cursor.fetchone():
+                return True
+    return False
+
+def save_editor_changes(table, df, editor_key, key_column="id"):
+    """Write only the rows changed in a data editor back to `table`.
+
+    Edited, added and deleted rows are applied as batched UPDATE, INSERT and
+    DELETE statements inside one transaction, so the table keeps its schema.
+    Does nothing when the editor reports no changes.
+    """
+    changes = st.session_state.get(editor_key) or {}
+    edited_rows = changes.get("edited_rows", {})
+    added_rows = changes.get("added_rows", [])
+    deleted_rows = changes.get("deleted_rows", [])
+    if not (edited_rows or added_rows or deleted_rows):
+        return
+
+    columns = set(df.columns)
+    keys = df[key_column]
+    updates = {}
+    for row_index, values in edited_rows.items():
+        values = {col: value for col, value in values.items() if col in columns}
+        if values:
+            updates.setdefault(tuple(sorted(values)), []).append(
+                [_to_sql_value(values[col]) for col in sorted(values)] + [_to_sql_value(keys.iloc[int(row_index)])]
+            )
+    inserts = {}
+    for values in added_rows:
+        values = {col: value for col, value in values.items() if col in columns and value is not None}
+        if values:
+            inserts.setdefault(tuple(sorted(values)), []).append([_to_sql_value(values[col]) for col in sorted(values)])
+    deletes = [(_to_sql_value(keys.iloc[int(row_index)]),) for row_index in deleted_rows]
+
+    try:
+        with get_connection() as conn:
+            for cols, params in updates.items():
+                assignments = ", ".join(f'"{col}" = ?' for col in cols)
+                conn.executemany(f'UPDATE "{table}" SET {assignments} WHERE "{key_column}" = ?', params)
+            for cols, params in inserts.items():
+                names = ", ".join(f'"{col}"' for col in cols)
+                placeholders = ", ".join("?" for _ in cols)
+                conn.executemany(f'INSERT INTO "{table}" ({names}) VALUES ({placeholders})', params)
+            if deletes:
+                conn.executemany(f'DELETE FROM "{table}" WHERE "{key_column}" = ?', deletes)
+            # Edits that change sales already rolled up recompute the rollups in the background
+            if changes_rolled_up_sales(conn.cursor(), table, updates, deletes):
+                queue_sales_rollup_rebuild(conn.cursor())
+            if table == 'purchases':
+                queue_recommendations_rebuild(conn.cursor())
+    except sqlite3.Error as error:
+        # The whole batch was rolled back; drop it from the editor too, or every later edit would retry it
+        st.session_state.editor_versions[table] = st.session_state.editor_versions.get(table, 0) + 1
+        st.session_state.editor_error = (table, str(error))
+        return
+    wake_job_workers()
+    if table == 'products':
+        invalidate_catalog()
+
+    # A fresh editor key drops the applied edits from the widget state
+    st.session_state.editor_versions[table] = st.session_state.editor_versions.get(table, 0) + 1
+    st.session_state.editor_saved = table
+
+GRID_PAGE_SIZES = [50, 100, 500]
+
+def grid_columns(cursor, table):
+    """Return the (name, declared type) columns the grid can sort on and filter on.
+
+    Sorting is offered on id and on columns with a single-column index, which
+    orders equal values by id as the pages need. Filtering is also offered on
+    the leading column of a composite index, such as purchases.user_id.
+    """
+    cursor.execute(f'PRAGMA index_list("{table}")')
+    indexes = [row[1] for row in cursor.fetchall() if not row[4]]
+    sortable, leading = {"id"}, set()
+    for index in indexes:
+        cursor.execute(f'PRAGMA index_info("{index}")')
+        index_columns = [row[2] for row in cursor.fetchall()]
+        (sortable if len(index_columns) == 1 else leading).add(index_columns[0])
+    columns = table_columns(cursor, table)
+    return ([(name, declared) for name, declared in columns if name in sortable],
+            [(name, declared) for name, declared in columns if name in sortable | leading])
+
+def grid_filter(name, declared, value):
+    # WHERE clause for a filter on an indexed column. Numbers match exactly and
+    # text by prefix, written as a range so the column's index serves it.
+    value = value.strip()
+    if not value:
+        return [], []
+    if is_numeric_column(declared):
+        try:
+            return [f'"{name}" = ?'], [float(value)]
+        except ValueError:
+            raise ValueError(f"The {name} filter must be a number")
+    return [f'"{name}" >= ? AND "{name}" < ?'], [value, value + "\U0010ffff"]
+
+def fetch_grid_page(cursor, table, sort, descending, clauses, params, after, page_size):
+    """Return up to page_size + 1 rows of `table` following `after` in (sort, id) order.
 
+    `after` is the (sort value, id) of the last row on the previous page, or
+    None for the first page, so every page is a seek on the sort column's
+    index however deep it is. NULLs sort first ascending and last
+    descending; they are read by their own seek on `sort IS NULL`.
+    """
+    op, direction = ("<", "DESC") if descending else (">", "ASC")
+    by_value, by_id = f'"{sort}" {direction}, id {direction}', f"id {direction}"
+    if sort == "id":
+        segments = [(f"id {op} ?", [after[1]], by_id)] if after else [("1", [], by_id)]
+    else:
+        nulls = (f'"{sort}" IS NULL', [], by_id)
+        values = (f'"{sort}" IS NOT NULL', [], by_value)
+        if after is None:
+            segments = [values, nulls] if descending else [nulls, values]
+        elif after[0] is None:
+            segments = [(f'"{sort}" IS NULL AND id {op} ?', [after[1]], by_id)] + ([] if descending else [values])
+        else:
+            segments = [(f'("{sort}", id) {op} (?, ?)', list(after), by_value)] + ([nulls] if descending else [])
+    rows = []
+    for segment, segment_params, order in segments:
+        if len(rows) > page_size:
+            break
+        where = " AND ".join([segment] + clauses)
+        cursor.execute(f'SELECT * FROM "{table}" WHERE {where} ORDER BY {order} LIMIT ?',
+                       segment_params + params + [page_size + 1 - len(rows)])
+        rows += cursor.fetchall()
+    return rows, [column[0] for column in cursor.description]
+
+def reset_grid(table):
+    # A new sort, filter or page size starts over on the first page with a fresh editor
+    st.session_state[f"{table}_grid_pages"] = [None]
+    st.session_state.editor_versions[table] = st.session_state.editor_versions.get(table, 0) + 1
+
+def table_editor(table):
+    """Edit `table` one page at a time, saving row-level changes as they are made.
+
+    Sorting and filtering are limited to indexed columns and run in SQLite;
+    pages are keyset seeks, and only the visible page is read and sent to
+    the browser.
+    """
+    import pandas as pd
+    if 'editor_versions' not in st.session_state:
+        st.session_state.editor_versions = {}
+    with get_cursor() as cursor:
+        columns = table_columns(cursor, table)
+        sortable, filterable = grid_columns(cursor, table)
+    declared_types = dict(columns)
+
+    sort_column, order_column, size_column = st.columns([2, 1, 1])
+    sort = sort_column.selectbox("Sort by", [name for name, _ in sortable], key=f"{table}_grid_sort", on_change=reset_grid, args=(table,))
+    descending = order_column.toggle("Descending", key=f"{table}_grid_descending", on_change=reset_grid, args=(table,))
+    page_size = size_column.selectbox("Rows per page", GRID_PAGE_SIZES, key=f"{table}_grid_page_size", on_change=reset_grid, args=(table,))
+    filter_column, value_column = st.columns([1, 3])
+    filter_on = filter_column.selectbox("Filter on", [name for name, _ in filterable], key=f"{table}_grid_filter_on",
+                                        on_change=reset_grid, args=(table,))
+    numeric = is_numeric_column(declared_types[filter_on])
+    value = value_column.text_input(f"Filter {filter_on}", key=f"{table}_grid_filter_{filter_on}", on_change=reset_grid,
+                                    args=(table,), help="equals" if numeric else "starts with")
+    try:
+        clauses, params = grid_filter(filter_on, declared_types[filter_on], value)
+    except ValueError as error:
+        st.error(str(error))
+        return
+    if clauses and filter_on != sort:
+        # The filter's index only yields its rows in id order
+        sort = "id"
+        st.caption(f"Rows filtered on {filter_on} are listed by id")
+
+    # Counting every matching row is a scan, so it is done once per filter and saved edit
+    count_key = (sort, filter_on, tuple(params), st.session_state.editor_versions.get(table, 0))
+    counts = st.session_state.setdefault("grid_counts", {})
+    if table not in counts or counts[table][0] != count_key:
+        with get_cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM "{table}"' + (" WHERE " + " AND ".join(clauses) if clauses else ""), params)
+            counts[table] = (count_key, cursor.fetchone()[0])
+    total = counts[table][1]
+
+    pages_key = f"{table}_grid_pages"
+    if pages_key not in st.session_state:
+        st.session_state[pages_key] = [None]
+    pages = st.session_state[pages_key]
+    with get_cursor() as cursor:
+        rows, names = fetch_grid_page(cursor, table, sort, descending, clauses, params, pages[-1], page_size)
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    if not rows and len(pages) > 1:
+        # Rows were deleted since the page was picked
+        pages.pop()
+        st.rerun()
+    offset = (len(pages) - 1) * page_size
+    st.caption(f"Rows {offset + 1:,}-{offset + len(rows):,} of {total:,}" if rows else "No matching rows")
+
+    with get_profiler().section("pandas"):
+        df = pd.DataFrame.from_records(rows, columns=names)
+        # All-NULL columns would otherwise come back as text in the editor
+        for name, declared in columns:
+            if is_numeric_column(declared):
+                df[name] = pd.to_numeric(df[name])
+    editor_key = f"{table}_editor_{st.session_state.editor_versions.get(table, 0)}_{len(pages)}"
+    st.data_editor(
+        df,
+        use_container_width=True,
+        num_rows="dynamic",
+        disabled=["id"],
+        key=editor_key,
+        on_change=save_editor_changes,
+        args=(table, df, editor_key),
+    )
+    if st.session_state.get("editor_saved") == table:
+        st.session_state.editor_saved = None
+        st.success("Changes saved successfully!")
+    editor_error = st.session_state.get("editor_error")
+    if editor_error and editor_error[0] == table:
+        st.session_state.editor_error = None
+        st.error(f"Changes not saved: {editor_error[1]}")
+
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    with prev_col:
+        if st.button("Previous page", key=f"{table}_grid_previous", disabled=len(pages) == 1):
+            pages.pop()
+            st.rerun()
+    with page_col:
+        st.write(f"Page {len(pages)} of {max(1, -(-total // page_size)):,}")
+    with next_col:
+        if st.button("Next page", key=f"{table}_grid_next", disabled=not has_next):
+            last = rows[-1]
+            pages.append((last[names.index(sort)], last[names.index("id")]))
+            st.rerun()
+
+def product_image_uploader():
+    with st.expander("Product image"):
+        product_id = st.number_input("Product ID", min_value=1, step=1)
+        uploaded = st.file_uploader("Image", type=["png", "jpg", "jpeg", "webp"])
+        if st.button("Save image", disabled=uploaded is None):
+            from PIL import UnidentifiedImageError
+            try:
+                saved = save_product_image(int(product_id), uploaded.getvalue())
+            except UnidentifiedImageError:
+                st.error("That file could not be read as an image")
+            else:
+                if saved:
+                    st.success(f"Image saved for product {int(product_id)}")
+                else:
+                    st.error(f"There is no product with ID {int(product_id)}")
+
+def bulk_transfer(table):
+    with st.expander("Bulk import and export"):
+        uploaded = st.file_uploader("CSV or Parquet file", type=["csv", "parquet"], key=f"bulk_file_{table}")
+        if st.button("Import", disabled=uploaded is None, key=f"bulk_import_{table}"):
+            status = st.empty()
+
+            def progress(rows, seconds):
+                status.write(f"Loaded {rows:,} rows ({rows / max(seconds, 1e-6):,.0f} rows/s)")
+
+            try:
+                rows, seconds = bulk_import(table, uploaded, bulk_format(uploaded.name), progress)
+            except (ValueError, RuntimeError, sqlite3.Error) as error:
+                st.error(f"Import failed, nothing was loaded: {error}")
+            else:
+                st.success(f"Imported {rows:,} rows into {table} in {seconds:.1f}s")
+
+        file_format = st.radio("Export format", ["csv", "parquet"], horizontal=True, key=f"bulk_format_{table}")
+
+        def export():
+            buffer = io.BytesIO()
+            bulk_export(table, buffer, file_format)
+            return buffer.getvalue()
+
+        # The file is only built when the button is clicked
+        st.download_button("Export", data=export, file_name=f"{table}.{file_format}", on_click="ignore", key=f"bulk_export_{table}")
+
+@profiled_page
 def host_products_page():
     st.markdown('<h1 class="centered-title">Products and Purchases</h1>', unsafe_allow_html=True)
-    tab1, tab2, tab3 = st.tabs(["Products", "Purchases", "Users"])
-
-    with tab1:
-        # Create a pandas dataframe for products
-        products_df = pd.read_sql_table('products', engine)
-        edited_df = st.data_editor(products_df, use_container_width=True, num_rows="dynamic")
-
-        # Update the database with the edited dataframe
-        if edited_df is not None:
-            edited_df.to_sql('products', engine, if_exists='replace', index=False)
-            st.success("Changes saved successfully!")
-
-    with tab2:
-        # Create a pandas dataframe for purchases
-        purchases_df = pd.read_sql_table('purchases', engine)
-        edited_df = st.data_editor(purchases_df, use_container_width=True, num_rows="dynamic")
-
-        # Update the database with the edited dataframe
-        if edited_df is not None:
-            edited_df.to_sql('purchases', engine, if_exists='replace', index=False)
-            st.success("Changes saved successfully!")
-    
-    with tab3:
-        # Create a pandas dataframe for users
-        users_df = pd.read_sql_table('users', engine)
-        edited_df = st.data_editor(users_df, use_container_width=True, num_rows="dynamic")
-
-        # Update the database with the edited dataframe
-        if edited_df is not None:
-            edited_df.to_sql('users', engine, if_exists='replace', index=False)
-            st.success("Changes saved successfully!")
+    # Only the selected table is loaded; st.tabs would read all three every rerun.
+    table = st.radio("Table", ["Products", "Purchases", "Users"], horizontal=True,
+                     key="host_table", label_visibility="collapsed")
+    table_editor(table.lower())
+    bulk_transfer(table.lower())
+    if table == "Products":
+        product_image_uploader()
 
+@profiled_page
 def host_profile_page():
     st.markdown('<h1 class="centered-title">Host Profile</h1>', unsafe_allow_html=True)
     st.write(f"Username: {st.session_state.current_host[1]}")
@@ -521,8 +2719,152 @@ def host_profile_page():
     </style>
     """, unsafe_allow_html=True)
 
+def cli(argv=None):
+    # Maintenance commands, for when the script is run with plain python instead of streamlit
+    parser = argparse.ArgumentParser(description="Maintenance commands for the store database.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="apply pending schema migrations")
+    subparsers.add_parser("check-plans", help="exit non-zero if a hot query falls back to a table scan")
+    for command, help_text in (("import", "append a CSV or Parquet file to a table"), ("export", "write a table to a CSV or Parquet file")):
+        transfer = subparsers.add_parser(command, help=help_text)
+        transfer.add_argument("table", choices=BULK_TABLES)
+        transfer.add_argument("path")
+        transfer.add_argument("--format", choices=["csv", "parquet"], help="default: from the file extension")
+        transfer.add_argument("--chunk-rows", type=int, default=BULK_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    get_connection_pool()
+    if args.command == "check-plans":
+        with get_cursor() as cursor:
+            failures = check_query_plans(cursor)
+        for name, scans in failures.items():
+            print(f"{name}: {'; '.join(scans)}")
+        print(f"{len(HOT_QUERIES) - len(failures)}/{len(HOT_QUERIES)} hot queries use an index")
+        sys.exit(1 if failures else 0)
+    if args.command in ("import", "export"):
+        file_format = args.format or bulk_format(args.path)
+        started = time.perf_counter()
+        if args.command == "import":
+            def progress(rows, seconds):
+                print(f"\r{rows:,} rows, {rows / max(seconds, 1e-6):,.0f} rows/s", end="", file=sys.stderr, flush=True)
+            try:
+                rows, seconds = bulk_import(args.table, args.path, file_format, progress, args.chunk_rows)
+            except (ValueError, RuntimeError, sqlite3.Error) as error:
+                sys.exit(f"\nimport failed, nothing was loaded: {error}")
+            print(file=sys.stderr)
+        else:
+            rows = bulk_export(args.table, args.path, file_format, args.chunk_rows)
+            seconds = time.perf_counter() - started
+        print(f"{args.command}ed {rows:,} rows in {seconds:.2f}s ({rows / max(seconds, 1e-6):,.0f} rows/s)")
+
+def host_profiler_page():
+    import pandas as pd
+    st.markdown('<h1 class="centered-title">Profiler</h1>', unsafe_allow_html=True)
+    profiler = get_profiler()
+    profiler.enabled = st.toggle("Profile queries", value=profiler.enabled)
+    if st.button("Reset profile"):
+        profiler.reset()
+
+    with profiler.lock:
+        pages = {name: dict(stats, recent_ms=sorted(stats["recent_ms"])) for name, stats in profiler.pages.items()}
+        slow_queries = list(profiler.slow_queries)
+    if not pages:
+        st.write("No page runs recorded yet. Turn profiling on and use the app.")
+        return
+
+    st.subheader("Pages")
+    st.dataframe(pd.DataFrame([
+        {
+            "Page": name,
+            "Runs": stats["runs"],
+            "Queries per run": round(stats["queries"] / stats["runs"], 1),
+            "SQL ms per run": round(stats["sql_ms"] / stats["runs"], 1),
+            "Pandas ms per run": round(stats["pandas_ms"] / stats["runs"], 1),
+            "Rendering ms per run": round(stats["render_ms"] / stats["runs"], 1),
+            "p95 ms": round(stats["recent_ms"][int(0.95 * (len(stats["recent_ms"]) - 1))], 1),
+        }
+        for name, stats in sorted(pages.items())
+    ]), use_container_width=True, hide_index=True)
+
+    st.subheader(f"Slow queries (over {SLOW_QUERY_MS} ms)")
+    if slow_queries:
+        st.dataframe(pd.DataFrame([
+            {"At": q["at"], "Page": q["page"], "ms": round(q["ms"], 1), "Rows": q["rows"], "SQL": q["sql"].strip(), "Plan": q["plan"]}
+            for q in reversed(slow_queries)
+        ]), use_container_width=True, hide_index=True)
+    else:
+        st.write("None recorded.")
+
+@profiled_page
+def host_jobs_page():
+    import pandas as pd
+    st.markdown('<h1 class="centered-title">Jobs</h1>', unsafe_allow_html=True)
+    metrics = job_metrics()
+    if not metrics:
+        st.write("No jobs have been queued yet.")
+        return
+    queued = sum(row[1] or 0 for row in metrics)
+    oldest = max((row[5] or 0 for row in metrics), default=0)
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Queued", f"{queued:,}")
+    col2.metric("Oldest wait", f"{oldest:.1f}s")
+    col3.metric("Failed", f"{sum(row[3] or 0 for row in metrics):,}")
+    with get_profiler().section("pandas"):
+        st.dataframe(pd.DataFrame(metrics, columns=[
+            "Kind", "Queued", "Running", "Failed", "Done", "Oldest wait (s)", "Avg wait (s)", "Avg run (s)", "Retried",
+        ]).round(3), hide_index=True, use_container_width=True)
+
+    with get_cursor() as cursor:
+        cursor.execute("SELECT id, kind, attempts, error FROM jobs WHERE status = 'failed' ORDER BY finished_at DESC LIMIT 20")
+        failed = cursor.fetchall()
+    if failed:
+        st.subheader("Failed jobs")
+        with get_profiler().section("pandas"):
+            st.dataframe(pd.DataFrame(failed, columns=["ID", "Kind", "Attempts", "Error"]), hide_index=True, use_container_width=True)
+        if st.button("Retry failed jobs"):
+            with get_cursor() as cursor:
+                # OR IGNORE leaves a failed job alone if the same job is already queued again
+                cursor.execute("UPDATE OR IGNORE jobs SET status = 'queued', attempts = 0, run_after = ? WHERE status = 'failed'", (time.time(),))
+            wake_job_workers()
+            st.rerun()
+
+def sign_out_page():
+    if st.button("Sign Out"):
+        st.session_state.current_user = None
+        st.session_state.current_host = None
+        st.session_state.page = "Login"
+        st.rerun()
+
+# Navigation: st.tabs runs every tab body on each rerun, so the pages are
+# picked with a radio kept in session state and only the visible one executes.
+USER_PAGES = {
+    "Home": user_home_page,
+    "Products": products_page,
+    "Popular": popular_products_page,
+    "Cart": cart_page,
+    "Profile": user_profile_page,
+    "Contact": contact_page,
+    "Sign Out": sign_out_page,
+}
+
+HOST_PAGES = {
+    "Dashboard": host_dashboard_page,
+    "Products and Purchases": host_products_page,
+    "Profile": host_profile_page,
+    "Profiler": host_profiler_page,
+    "Jobs": host_jobs_page,
+    "Sign Out": sign_out_page,
+}
+
+def show_page(pages, key):
+    choice = st.radio("Page", list(pages), horizontal=True, key=key, label_visibility="collapsed")
+    pages[choice]()
+
 # Main app logic
 def main():
+    apply_page_style()
+    init_session_state()
+    start_job_workers()
     if not st.session_state.current_user and not st.session_state.current_host:
         if st.session_state.page == "Login":
             login_page()
@@ -531,39 +2873,12 @@ def main():
         elif st.session_state.page == "Forgot Password":
             forgot_password_page()
     elif st.session_state.current_host:
-        tabs = st.tabs(["Dashboard", "Products and Purchases", "Profile", "Sign Out"])
-        
-        with tabs[0]:
-            host_dashboard_page()
-        with tabs[1]:
-            host_products_page()
-        with tabs[2]:
-            host_profile_page()
-        with tabs[3]:
-            if st.button("Sign Out"):
-                st.session_state.current_host = None
-                st.session_state.page = "Login"
-                st.rerun()
+        show_page(HOST_PAGES, "host_page")
     else:
-        tabs = st.tabs(["Home", "Products", "Popular", "Cart", "Profile", "Contact", "Sign Out"])
-        
-        with tabs[0]:
-            user_home_page()
-        with tabs[1]:
-            products_page()
-        with tabs[2]:
-            popular_products_page()
-        with tabs[3]:
-            cart_page()
-        with tabs[4]:
-            user_profile_page()
-        with tabs[5]:
-            contact_page()
-        with tabs[6]:
-            if st.button("Sign Out"):
-                st.session_state.current_user = None
-                st.session_state.page = "Login"
-                st.rerun()
+        show_page(USER_PAGES, "user_page")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if st.runtime.exists():
+        main()
+    else:
+        cli()
@@ -0,0 +1,583 @@
+"""Benchmarks for the store.
+
+Each benchmark runs against a synthetic database in a temporary directory
+(or in --workdir, which is reused when it already holds a database of the
+requested size), so mydatabase.db is never touched. Results are printed as
+JSON and, with --output, written to a file so runs can be compared across
+versions:
+
+    python benchmark.py search --products 1000000
+    python benchmark.py --output pages.json pages --users 1000 --products 100000 --purchases 2000000
+    python benchmark.py import --products 1000000 --format parquet
+    python benchmark.py startup --budget-ms 1000
+    python benchmark.py contention --buyers 64 --stock 50 --quantity 2
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app6.py")
+
+WORDS = [
+    "wireless", "bluetooth", "laptop", "phone", "charger", "cable", "headphones", "earphones",
+    "speaker", "keyboard", "mouse", "monitor", "camera", "tripod", "backpack", "sleeve",
+    "stand", "adapter", "battery", "case", "screen", "protector", "gaming", "office",
+    "portable", "compact", "premium", "classic", "smart", "watch", "tablet", "stylus",
+]
+
+SYLLABLES = ["ka", "lo", "mi", "ner", "tra", "vo", "zen", "qui", "pex", "ro", "sul", "dan", "fi", "gor"]
+
+# Statements run on any connection the app opens, counted by trace_statements()
+_statements = [0]
+_statement_lock = threading.Lock()
+
+def make_vocabulary(rng, size=5000):
+    # Brand-like words so that, as in a real catalog, most terms are rare
+    vocabulary = set(WORDS)
+    while len(vocabulary) < size:
+        vocabulary.add("".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(vocabulary)
+
+def trace_statements():
+    """Count every SQL statement the app runs, on pooled and SQLAlchemy connections alike.
+
+    Transaction control, pragmas and statements run by triggers are not counted.
+    """
+    connect = sqlite3.connect
+
+    def count(statement):
+        if not statement.lstrip().upper().startswith(("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "--")):
+            with _statement_lock:
+                _statements[0] += 1
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(count)
+        return conn
+
+    sqlite3.connect = traced_connect
+
+def statements_run():
+    with _statement_lock:
+        return _statements[0]
+
+def load_app(workdir, trace=True):
+    # app6 opens mydatabase.db relative to the working directory
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    if trace:
+        # The callback also fires for the statements FTS5 runs per matching row,
+        # so benchmarks timing search leave it off
+        trace_statements()
+    import app6
+    app6.get_connection_pool()
+    return app6
+
+def product_rows(count):
+    # (name, price, is_popular, description) tuples
+    rng = random.Random(42)
+    vocabulary = make_vocabulary(rng)
+    for _ in range(count):
+        name = " ".join([rng.choice(vocabulary)] + rng.sample(WORDS, 2)).title()
+        description = " ".join(rng.choices(vocabulary, k=6) + rng.choices(WORDS, k=6))
+        yield name, round(rng.uniform(5, 1500), 2), int(rng.random() < 0.05), description
+
+def make_products(app, count, batch_size=10000):
+    rows = product_rows(count)
+    for start in range(0, count, batch_size):
+        with app.get_connection() as conn:
+            conn.executemany("INSERT INTO products (name, price, is_popular, description) VALUES (?, ?, ?, ?)",
+                             itertools.islice(rows, batch_size))
+
+def make_users(app, count, batch_size=10000):
+    for start in range(0, count, batch_size):
+        rows = [(f"shopper{i}", "1234", f"shopper{i}@example.com", "phrase") for i in range(start, min(count, start + batch_size))]
+        with app.get_connection() as conn:
+            conn.executemany("INSERT INTO users (username, password, email, restore_phrase) VALUES (?, ?, ?, ?)", rows)
+
+def make_purchases(app, count, batch_size=50000):
+    # A skewed product distribution, so a few products sell most, spread over the past year
+    rng = random.Random(11)
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT MIN(id), MAX(id) FROM users WHERE username LIKE 'shopper%'")
+        first_user, last_user = cursor.fetchone()
+        cursor.execute("SELECT MIN(id), MAX(id) FROM products")
+        first_product, last_product = cursor.fetchone()
+    product_span = last_product - first_product + 1
+    now = datetime.datetime.now()
+    for start in range(0, count, batch_size):
+        rows = []
+        for _ in range(min(batch_size, count - start)):
+            product_id = first_product + min(product_span - 1, int(rng.paretovariate(1.2)) - 1)
+            date = now - datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+            rows.append((rng.randint(first_user, last_user), product_id, rng.randint(1, 3), date.isoformat(sep=" ")))
+        with app.get_connection() as conn:
+            conn.executemany("INSERT INTO purchases (user_id, product_id, quantity, date) VALUES (?, ?, ?, ?)", rows)
+
+def build_database(app, users, products, purchases):
+    """Fill the app's database with synthetic shoppers, catalog and order history, unless it already has them."""
+    started = time.perf_counter()
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE username LIKE 'shopper%'")
+        have_users = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM products")
+        have_products = cursor.fetchone()[0]
+    if users and not have_users:
+        make_users(app, users)
+    if have_products < products:
+        make_products(app, products - have_products)
+    if purchases:
+        with app.get_cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM purchases")
+            have_purchases = cursor.fetchone()[0]
+        if have_purchases < purchases:
+            make_purchases(app, purchases - have_purchases)
+    app.catch_up_sales_rollup()
+    app.catch_up_recommendations()
+    return round(time.perf_counter() - started, 2)
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "p50_ms": round(statistics.median(timings), 3),
+        "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+def measure(fn, inputs):
+    timings = []
+    for value in inputs:
+        started = time.perf_counter()
+        fn(value)
+        timings.append((time.perf_counter() - started) * 1000)
+    return summarize(timings)
+
+def profile_call(fn, runs):
+    """Latency, statements per call and peak Python memory of calling `fn` repeatedly."""
+    timings, statements = [], []
+    for _ in range(runs):
+        before = statements_run()
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+        statements.append(statements_run() - before)
+    # Memory is traced in a separate call, as tracing slows everything down
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = summarize(timings)
+    result["queries_per_run"] = round(statistics.mean(statements), 2)
+    result["peak_memory_kb"] = round(peak / 1024, 1)
+    return result
+
+def shopper_row(app, username="shopper0"):
+    with app.get_cursor() as cursor:
+        # The (id, username, email) identity the app keeps in session state
+        cursor.execute("SELECT id, username, email FROM users WHERE username = ?", (username,))
+        return cursor.fetchone()
+
+def host_row(app):
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT id, username, NULL FROM hosts ORDER BY id LIMIT 1")
+        host = cursor.fetchone()
+        if host is None:
+            cursor.execute("INSERT INTO hosts (username, password) VALUES ('host', '1234')")
+            cursor.execute("SELECT id, username, NULL FROM hosts ORDER BY id LIMIT 1")
+            host = cursor.fetchone()
+    return host
+
+def bench_page_functions(app, runs):
+    """Call each page function directly, outside a Streamlit server ("bare mode")."""
+    import streamlit as st
+    shopper, host = shopper_row(app), host_row(app)
+    app.init_session_state()
+    for product_id in range(1, 6):
+        app.add_to_cart(shopper[0], product_id)
+
+    def as_shopper(page):
+        def run():
+            st.session_state.current_user, st.session_state.current_host = shopper, None
+            page()
+        return run
+
+    def as_host(page):
+        def run():
+            st.session_state.current_user, st.session_state.current_host = None, host
+            page()
+        return run
+
+    pages = {
+        "login": lambda: app.login(shopper[1], "1234"),
+        "user_home_page": as_shopper(app.user_home_page),
+        "products_page": as_shopper(app.products_page),
+        "popular_products_page": as_shopper(app.popular_products_page),
+        "cart_page": as_shopper(app.cart_page),
+        "host_dashboard_page": as_host(app.host_dashboard_page),
+        "host_products_page": as_host(app.host_products_page),
+    }
+    return {name: profile_call(page, runs) for name, page in pages.items()}
+
+def bench_app_reruns(app, runs):
+    """Full script reruns through Streamlit's AppTest harness, as a signed-in shopper and host."""
+    from streamlit.testing.v1 import AppTest
+    results = {}
+    for role, row in (("shopper", shopper_row(app)), ("host", host_row(app))):
+        at = AppTest.from_file(APP_PATH, default_timeout=600)
+        at.session_state["current_user"] = row if role == "shopper" else None
+        at.session_state["current_host"] = row if role == "host" else None
+        at.session_state["page"] = "User Home" if role == "shopper" else "Host Dashboard"
+        at.run()
+        if at.exception:
+            raise RuntimeError(f"{role} rerun failed: {at.exception[0].message}")
+        results[role] = profile_call(at.run, runs)
+    return results
+
+def bench_concurrent(app, threads, operations):
+    """Many shoppers browsing, searching, filling carts and checking out at once on the shared pool."""
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT id FROM users WHERE username LIKE 'shopper%' ORDER BY id LIMIT ?", (threads,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT MAX(id) FROM products")
+        max_product = cursor.fetchone()[0]
+    vocabulary = make_vocabulary(random.Random(42))
+    timings = {"browse": [], "search": [], "add_to_cart": [], "checkout": []}
+    errors = []
+    lock = threading.Lock()
+
+    def shopper(user_id):
+        rng = random.Random(user_id)
+        local = {kind: [] for kind in timings}
+        try:
+            for step in range(operations):
+                kind = ("browse", "search", "add_to_cart", "add_to_cart", "checkout")[step % 5]
+                started = time.perf_counter()
+                if kind == "browse":
+                    app.fetch_product_page(rng.randint(0, max_product), app.PRODUCTS_PAGE_SIZE)
+                elif kind == "search":
+                    app.search_products(rng.choice(vocabulary), app.PRODUCTS_PAGE_SIZE)
+                elif kind == "add_to_cart":
+                    app.add_to_cart(user_id, rng.randint(1, max_product))
+                else:
+                    app.checkout(user_id, f"bench-{user_id}-{step}-{time.time_ns()}")
+                local[kind].append((time.perf_counter() - started) * 1000)
+        except Exception as error:
+            errors.append(repr(error))
+        with lock:
+            for kind, values in local.items():
+                timings[kind].extend(values)
+
+    workers = [threading.Thread(target=shopper, args=(user_id,)) for user_id in user_ids]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    operations_run = sum(len(values) for values in timings.values())
+    return {
+        "threads": len(workers),
+        "operations": operations_run,
+        "throughput_per_s": round(operations_run / elapsed, 1),
+        "errors": errors,
+        **{kind: summarize(values) for kind, values in timings.items() if values},
+    }
+
+def bench_pages(args):
+    app = load_app(args.workdir or tempfile.mkdtemp())
+    build_seconds = build_database(app, args.users, args.products, args.purchases)
+    return {
+        "benchmark": "pages",
+        "users": args.users,
+        "products": args.products,
+        "purchases": args.purchases,
+        "build_seconds": build_seconds,
+        "page_functions": bench_page_functions(app, args.runs),
+        "app_reruns": bench_app_reruns(app, args.runs),
+        "concurrent": bench_concurrent(app, args.threads, args.operations),
+    }
+
+def bench_search(args):
+    app = load_app(args.workdir or tempfile.mkdtemp(), trace=False)
+    build_database(app, 0, args.products, 0)
+    rng = random.Random(7)
+    vocabulary = make_vocabulary(random.Random(42))
+    # Rare brand words match a handful of products; common words and two-letter
+    # prefixes, as typed into the search box, match a large share of the catalog
+    queries = {
+        "rare": [rng.choice(vocabulary) for _ in range(args.queries)],
+        "common": [rng.choice(WORDS) for _ in range(args.queries)],
+        "prefix": [rng.choice(WORDS)[:2] for _ in range(args.queries)],
+    }
+
+    def like_search(query):
+        # The LIKE scan products_page used before products_fts existed
+        with app.get_cursor() as cursor:
+            cursor.execute("SELECT id, name, price, is_popular, description FROM products WHERE name LIKE ? AND is_popular = 0", ('%'+query+'%',))
+            cursor.fetchall()
+
+    def fts_search(query):
+        app.search_products(query, args.page_size)
+
+    return {
+        "benchmark": "search",
+        "products": args.products,
+        "page_size": args.page_size,
+        **{kind: {"like": measure(like_search, terms), "fts5": measure(fts_search, terms)}
+           for kind, terms in queries.items()},
+    }
+
+def bench_import(args):
+    """Bulk-load a products file through app6.bulk_import, then export it back."""
+    workdir = args.workdir or tempfile.mkdtemp()
+    app = load_app(workdir)
+    path = os.path.join(workdir, f"products.{args.format}")
+    rows = product_rows(args.products)
+    if args.format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        names = ["name", "price", "is_popular", "description"]
+        with pq.ParquetWriter(path, pa.schema([(n, t) for n, t in zip(names, [pa.string(), pa.float64(), pa.int64(), pa.string()])])) as writer:
+            for chunk in iter(lambda: list(itertools.islice(rows, 100000)), []):
+                writer.write_table(pa.Table.from_arrays([pa.array(values) for values in zip(*chunk)], names=names))
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "price", "is_popular", "description"])
+            writer.writerows(rows)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    loaded, seconds = app.bulk_import("products", path, args.format, chunk_rows=args.chunk_rows)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    exported = app.bulk_export("products", os.path.join(workdir, f"export.{args.format}"), args.format, args.chunk_rows)
+    export_seconds = time.perf_counter() - started
+    return {
+        "benchmark": "import",
+        "format": args.format,
+        "chunk_rows": args.chunk_rows,
+        "import": {"rows": loaded, "seconds": round(seconds, 2), "rows_per_s": round(loaded / seconds)},
+        "export": {"rows": exported, "seconds": round(export_seconds, 2), "rows_per_s": round(exported / export_seconds)},
+        # Growth of the process's peak resident memory during the import (KB on Linux)
+        "import_peak_rss_growth_kb": rss_after - rss_before,
+    }
+
+# Modules a shopper's first page must not pull in; they belong to host pages
+HOST_ONLY_MODULES = ["pandas", "plotly.express", "sqlalchemy", "pyarrow"]
+
+# Run in a fresh interpreter: import the app and render the login page in bare mode
+STARTUP_SCRIPT = """
+import json, sys
+import app6
+app6.main()
+print(json.dumps([name for name in %r if name in sys.modules]))
+""" % (HOST_ONLY_MODULES,)
+
+def bench_startup(args):
+    """Time from a cold interpreter to the rendered login page, checked against a budget."""
+    workdir = args.workdir or tempfile.mkdtemp()
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(APP_PATH))
+
+    def start(*flags):
+        started = time.perf_counter()
+        done = subprocess.run([sys.executable, *flags, "-c", STARTUP_SCRIPT], cwd=workdir, env=env,
+                              capture_output=True, text=True, check=True)
+        return (time.perf_counter() - started) * 1000, done
+
+    start()  # creates and migrates the database, which only the very first start pays for
+    timings = [start()[0] for _ in range(args.runs)]
+    _, traced = start("-X", "importtime")
+    loaded = json.loads(traced.stdout.strip().splitlines()[-1])
+
+    # -X importtime lines: "import time: self [us] | cumulative | package", nested imports indented
+    app_ms, app_imports = None, []
+    for line in traced.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() == "app6":
+            app_ms = int(cumulative) / 1000
+        elif depth == 1:
+            # Imported directly by app6 (or by one of the interpreter's own top-level imports)
+            app_imports.append((int(cumulative) / 1000, name.strip()))
+    result = summarize(timings)
+    return {
+        "benchmark": "startup",
+        "wall": result,
+        "budget_ms": args.budget_ms,
+        "app_import_ms": app_ms,
+        "slowest_imports_ms": {name: round(ms, 1) for ms, name in sorted(app_imports, reverse=True)[:10]},
+        "host_only_modules_loaded": loaded,
+        # p50 within budget and no host-only module on the login page
+        "passed": result["p50_ms"] <= args.budget_ms and not loaded,
+    }
+
+def bench_contention(args):
+    """Many buyers racing for one hot SKU: every checkout that goes through must be covered by stock."""
+    app = load_app(args.workdir or tempfile.mkdtemp())
+    build_database(app, args.buyers, 100, 0)
+    app.RESERVATION_TTL_SECONDS = args.reservation_ttl
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT id FROM users WHERE username LIKE 'shopper%' ORDER BY id LIMIT ?", (args.buyers,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM cart WHERE user_id IN (SELECT id FROM users WHERE username LIKE 'shopper%')")
+        cursor.execute("DELETE FROM stock_reservations")
+        cursor.execute("INSERT INTO products (name, price, is_popular, description, stock) VALUES (?, ?, 0, ?, ?)",
+                       ("Flash sale SKU", 9.99, "hot item", args.stock))
+        product_id = cursor.lastrowid
+    timings = {"add_to_cart": [], "checkout": []}
+    outcomes = {"bought": 0, "refused_at_cart": 0, "refused_at_checkout": 0}
+    errors = []
+    lock = threading.Lock()
+    start_line = threading.Barrier(len(user_ids))
+    # Every cart is filled before anyone checks out, so checkouts really race for the last units
+    checkout_line = threading.Barrier(len(user_ids))
+
+    def buyer(user_id):
+        local = {kind: [] for kind in timings}
+        try:
+            start_line.wait()
+            outcome = None
+            for _ in range(args.quantity):
+                started = time.perf_counter()
+                added = app.add_to_cart(user_id, product_id)
+                local["add_to_cart"].append((time.perf_counter() - started) * 1000)
+                if not added:
+                    app.update_cart_quantity(user_id, product_id, 0)
+                    outcome = "refused_at_cart"
+                    break
+            checkout_line.wait()
+            if outcome is None:
+                started = time.perf_counter()
+                try:
+                    app.checkout(user_id, f"flash-{product_id}-{user_id}")
+                    outcome = "bought"
+                except app.OutOfStock:
+                    app.update_cart_quantity(user_id, product_id, 0)
+                    outcome = "refused_at_checkout"
+                local["checkout"].append((time.perf_counter() - started) * 1000)
+        except Exception as error:
+            # Release the others rather than leave them waiting at a line this buyer never reaches
+            checkout_line.abort()
+            errors.append(repr(error))
+            outcome = None
+        with lock:
+            if outcome:
+                outcomes[outcome] += 1
+            for kind, values in local.items():
+                timings[kind].extend(values)
+
+    workers = [threading.Thread(target=buyer, args=(user_id,)) for user_id in user_ids]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    with app.get_cursor() as cursor:
+        cursor.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
+        remaining = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(SUM(quantity), 0), COUNT(DISTINCT order_id) FROM purchases WHERE product_id = ?", (product_id,))
+        sold, orders = cursor.fetchone()
+    sold_out = args.stock < len(user_ids) * args.quantity
+    # Without reservations nothing is held at the cart, so the overflow has to be refused at checkout
+    overbooked = args.reservation_ttl == 0 and args.stock < (len(user_ids) - outcomes["refused_at_cart"]) * args.quantity
+    return {
+        "benchmark": "contention",
+        "buyers": len(user_ids),
+        "stock": args.stock,
+        "quantity": args.quantity,
+        "reservation_ttl_s": args.reservation_ttl,
+        "seconds": round(elapsed, 3),
+        "buyers_per_s": round(len(user_ids) / elapsed, 1),
+        **outcomes,
+        "sold": sold,
+        "remaining_stock": remaining,
+        "errors": errors,
+        **{kind: summarize(values) for kind, values in timings.items() if values},
+        # Nothing oversold, every sale accounted for, the stock fully sold when demand exceeds it,
+        # and checkout turning buyers away whenever more carts were filled than the stock covers
+        "passed": (not errors and remaining >= 0 and sold == args.stock - remaining
+                   and orders == outcomes["bought"] and sold == outcomes["bought"] * args.quantity
+                   and (remaining < args.quantity if sold_out else remaining == args.stock - len(user_ids) * args.quantity)
+                   and (outcomes["refused_at_checkout"] > 0 if overbooked else True)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", help="directory for the synthetic database, reused between runs")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    search = subparsers.add_parser("search", help="compare LIKE scans with the FTS5 product search")
+    search.add_argument("--products", type=int, default=100000)
+    search.add_argument("--queries", type=int, default=200)
+    search.add_argument("--page-size", type=int, default=20)
+    search.set_defaults(run=bench_search)
+
+    pages = subparsers.add_parser("pages", help="rerun latency, queries and memory per page, plus concurrent shoppers")
+    pages.add_argument("--users", type=int, default=1000)
+    pages.add_argument("--products", type=int, default=10000)
+    pages.add_argument("--purchases", type=int, default=100000)
+    pages.add_argument("--runs", type=int, default=20, help="measured calls or reruns per page")
+    pages.add_argument("--threads", type=int, default=16, help="concurrent shoppers")
+    pages.add_argument("--operations", type=int, default=50, help="operations per concurrent shopper")
+    pages.set_defaults(run=bench_pages)
+
+    bulk = subparsers.add_parser("import", help="bulk import and export throughput for a products file")
+    bulk.add_argument("--products", type=int, default=1000000)
+    bulk.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    bulk.add_argument("--chunk-rows", type=int, default=50000)
+    bulk.set_defaults(run=bench_import)
+
+    startup = subparsers.add_parser("startup", help="cold start to the login page; exits 1 when over budget")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--budget-ms", type=float, default=1000)
+    startup.set_defaults(run=bench_startup)
+
+    contention = subparsers.add_parser("contention", help="concurrent buyers of one SKU with limited stock; exits 1 on oversell")
+    contention.add_argument("--buyers", type=int, default=64, help="concurrent buyers, one thread each")
+    contention.add_argument("--stock", type=int, default=50)
+    contention.add_argument("--quantity", type=int, default=2, help="units each buyer adds to the cart, one at a time")
+    contention.add_argument("--reservation-ttl", type=float, default=900,
+                            help="seconds a cart reservation holds stock; 0 leaves it all to the checkout check")
+    contention.set_defaults(run=bench_contention)
+
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    results = args.run(args)
+    results["environment"] = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if results.get("passed") is False:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()